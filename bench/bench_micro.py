@@ -0,0 +1,98 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+bench_micro.py
+Micro-benchmarks of the hot paths: SQL generated by ModelMetaClass, model construction,
+JSON encoding and template rendering. Prints microseconds per operation (best of 5 runs).
+
+    python bench/bench_micro.py [--save results.json] [--baseline baseline.json] [--tolerance 10]
+'''
+
+import time, timeit, logging, argparse
+
+import benchlib
+
+from orm import Model, ModelMetaClass, StringField, FloatField, TextField, compile_sql
+from models import Blog
+import serializer
+
+def make_rows(n):
+    return [dict(id='%050d' % i, user_id='u%d' % i, user_name='name', user_image='image', title='title %d' % i,
+        summary='summary ' * 20, content='content ' * 200, content_html='<p>%s</p>' % ('content ' * 200),
+        content_hash='%040d' % i, created_time=time.time()) for i in range(n)]
+
+def _define_model():
+    return ModelMetaClass('BenchModel', (Model,), dict(__table__='bench', id=StringField(primary_key=True),
+        name=StringField(), content=TextField(), created_time=FloatField()))
+
+def sql_cases():
+    objs = [Blog(**r) for r in make_rows(100)]
+    return [
+        ('sql.define_model', _define_model, 200),
+        ('sql.build_select', lambda: Blog._build_select('user_id=?', 'created_time desc', 2), 10000),
+        ('sql.select_cached', lambda: Blog._select_sql('user_id=?', 'created_time desc', 2), 100000),
+        ('sql.compile', lambda: compile_sql(Blog.__select__ + ' where `id`=?'), 100000),
+        ('sql.insert_many_100', lambda: Blog._insert_many(objs), 200),
+    ]
+
+def model_cases():
+    row = make_rows(1)[0]
+    blog = Blog(**row)
+    return [
+        ('model.construct', lambda: Blog(**row), 100000),
+        ('model.record', lambda: Blog.__record__(**row), 100000),
+        ('model.save_args', lambda: list(map(blog.getValueOrDefault, Blog.__fields__)), 100000),
+        ('model.to_dict', blog.toDict, 100000),
+    ]
+
+def json_cases():
+    rows = make_rows(100)
+    models = dict(blogs=[Blog(**r) for r in rows])
+    records = dict(blogs=[Blog.__record__(**r) for r in rows])
+    return [
+        ('json.models_100', lambda: serializer.dumps(models), 200),
+        ('json.records_100', lambda: serializer.dumps(records), 200),
+    ]
+
+def template_cases():
+    import app, assets, rendering
+    env = dict()
+    app.init_jinja2(env, filters=dict(datetime=app.datetime_filter),
+        globals=dict(static_url=assets.Assets().url, content_html=rendering.content_html), auto_reload=False)
+    env = env['__templating__']
+    blogs = [Blog.__record__(**r) for r in make_rows(20)]
+    index = env.get_template('blogs.html')
+    page = env.get_template('blog.html')
+    return [
+        ('template.index_20', lambda: index.render(blogs=blogs), 500),
+        ('template.blog', lambda: page.render(blog=blogs[0], comments=blogs[1:]), 500),
+    ]
+
+def run(cases):
+    results = dict()
+    for name, fn, number in cases:
+        best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        results[name] = dict(us=best * 1e6)
+        print('%-24s %12.2f us %14.0f ops/s' % (name, best * 1e6, 1.0 / best))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the ORM, JSON and templates.')
+    parser.add_argument('--save', help='write the results to this JSON file, e.g. to make a baseline')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='percent worse counted as a regression')
+    options = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)        #ModelMetaClass logs every model it defines
+    results = dict()
+    for cases in (sql_cases, model_cases, json_cases, template_cases):
+        results.update(run(cases()))
+    if options.save:
+        benchlib.save(results, options.save)
+    if options.baseline:
+        regressions = benchlib.compare(results, options.baseline, options.tolerance)
+        if regressions:
+            raise SystemExit('Regressions: %s' % ', '.join(regressions))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+bench_rows.py
+Compare Model (dict subclass) rows with the slotted Record rows generated by ModelMetaClass:
+memory per row and attribute access time.
+
+    python bench/bench_rows.py [rows]
+'''
+
+import os, sys, time, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+from models import Blog
+
+def make_rows(n):
+    return [dict(id='%050d' % i, user_id='u%d' % i, user_name='name', user_image='image',
+        title='title %d' % i, summary='summary', content='content', created_time=time.time()) for i in range(n)]
+
+def measure(factory, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [factory(**r) for r in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    access = timeit.timeit(lambda: [(o.title, o.summary, o.created_time) for o in objs], number=10)
+    return (after - before) / len(rows), access / (10 * len(rows) * 3)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(n)
+    print('%d rows of %s' % (n, Blog.__table__))
+    print('%-10s %14s %16s' % ('row', 'bytes/row', 'ns/attribute'))
+    for name, factory in (('Model', Blog), ('Record', Blog.__record__)):
+        size, access = measure(factory, rows)
+        print('%-10s %14.0f %16.1f' % (name, size, access * 1e9))
+
+if __name__ == '__main__':
+    main()
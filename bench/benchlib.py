@@ -0,0 +1,68 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+benchlib.py
+Helpers shared by the benchmarks: percentiles, memory, and baselines to compare runs with.
+A baseline is the JSON of a previous run, {name: {metric: value}}.
+'''
+
+import os, sys, json
+
+WWW = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www')
+sys.path.insert(0, WWW)
+
+#Metrics where a higher value is better, the others (latencies, memory) are better lower
+HIGHER_IS_BETTER = ('rps', 'requests')
+
+def percentile(values, p):
+    '''
+    p-th percentile of values (sorted), by nearest rank.
+    '''
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+def rss_kb(pid='self'):
+    '''
+    (current, peak) resident memory of a process in KB, from /proc (Linux only, else None).
+    '''
+    fields = dict()
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    name, value = line.split(':', 1)
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        return None, None
+    return fields.get('VmRSS'), fields.get('VmHWM')
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Saved results to %s' % path)
+
+def compare(results, path, tolerance=10.0):
+    '''
+    Print the change of every metric against the baseline at path, and return the names of
+    those worse by more than tolerance percent.
+    '''
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = []
+    print('\nAgainst baseline %s (tolerance %s%%):' % (path, tolerance))
+    for name in sorted(results):
+        for metric, value in sorted(results[name].items()):
+            old = baseline.get(name, {}).get(metric)
+            if not old or not isinstance(value, (int, float)):
+                continue
+            change = (value - old) * 100.0 / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions.append('%s.%s' % (name, metric))
+            print('  %-28s %-8s %12.3f -> %12.3f  %+7.1f%%%s' % (name, metric, old, value, change, flag))
+    return regressions
@@ -0,0 +1,116 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+fakedb.py
+Stand-in for aiomysql backed by an in-memory SQLite database, so the benchmarks run without a
+MySQL server. Install it before the pool is created and create the tables of the models:
+
+    orm.aiomysql = fakedb
+    fakedb.create_tables(User, Blog, Comment)
+
+Only what orm uses is implemented. Every pooled connection shares one SQLite connection and
+statements run synchronously on the event loop, transactions are not isolated. SQLite latency
+is not MySQL latency: compare runs against each other, not against production.
+'''
+
+import sqlite3, asyncio
+
+OperationalError = sqlite3.OperationalError
+
+class DictCursor(object):
+    pass
+
+class SSDictCursor(DictCursor):
+    pass
+
+_db = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)        #Autocommit
+
+def create_tables(*models):
+    '''
+    Create the table of every model from its fields, rows of a previous run are dropped.
+    '''
+    for model in models:
+        columns = ['`%s` %s' % (name, field.column_type) for name, field in model.__mappings__.items()]
+        columns.append('primary key (`%s`)' % model.__primary_key__)
+        _db.execute('drop table if exists `%s`' % model.__table__)
+        _db.execute('create table `%s` (%s)' % (model.__table__, ', '.join(columns)))
+
+class Cursor(object):
+    def __init__(self, dicts):
+        self._cur = _db.cursor()
+        self._dicts = dicts
+        self.rowcount = -1
+
+    def _rows(self, rows):
+        if not self._dicts:
+            return rows
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    @asyncio.coroutine
+    def execute(self, sql, args=()):
+        self._cur.execute(sql.replace('%s', '?'), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    @asyncio.coroutine
+    def fetchall(self):
+        return self._rows(self._cur.fetchall())
+
+    @asyncio.coroutine
+    def fetchmany(self, size):
+        return self._rows(self._cur.fetchmany(size))
+
+    @asyncio.coroutine
+    def close(self):
+        self._cur.close()
+
+class Connection(object):
+    @asyncio.coroutine
+    def cursor(self, factory=None):
+        return Cursor(factory is not None and issubclass(factory, DictCursor))
+
+    @asyncio.coroutine
+    def begin(self):
+        pass
+
+    @asyncio.coroutine
+    def commit(self):
+        pass
+
+    @asyncio.coroutine
+    def rollback(self):
+        pass
+
+class Pool(object):
+    '''
+    Pool of at most maxsize checked out connections, acquiring waits like aiomysql's.
+    '''
+    def __init__(self, minsize, maxsize):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.size = maxsize
+        self._free = asyncio.Semaphore(maxsize)
+
+    @property
+    def freesize(self):
+        return self._free._value
+
+    @asyncio.coroutine
+    def acquire(self):
+        yield from self._free.acquire()
+        return Connection()
+
+    def release(self, conn):
+        self._free.release()
+
+    def close(self):
+        pass
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        pass
+
+@asyncio.coroutine
+def create_pool(minsize=1, maxsize=10, **kw):
+    return Pool(minsize, maxsize)
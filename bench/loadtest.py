@@ -0,0 +1,207 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+loadtest.py
+HTTP load harness. Starts the app in a child process on the SQLite stand-in (see fakedb.py)
+seeded with users and blogs, then drives each scenario with concurrency clients for duration
+seconds and reports RPS, p50/p95/p99 latency and the memory of the server.
+
+    python bench/loadtest.py [-c 50] [-d 10] [--scenarios index,users,register]
+                             [--save results.json] [--baseline baseline.json]
+
+With --url the requests go to a server already running (e.g. on MySQL) instead,
+its memory is reported when --pid is given.
+'''
+
+import os, json, time, uuid, socket, signal, hashlib, inspect, argparse, tempfile, asyncio
+import multiprocessing
+
+import aiohttp
+
+import benchlib
+
+def _sha1(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def seed(users, blogs):
+    '''
+    Insert users and blogs straight into SQLite, without going through the app.
+    '''
+    import fakedb
+    from models import User, Blog
+    now = time.time()
+    rows = dict(
+        users=[User(id='%050d' % i, email='seed%d@example.com' % i, password=_sha1(str(i)), admin=False,
+            name='user %d' % i, image='about:blank', created_time=now - i) for i in range(users)],
+        blogs=[Blog(id='%050d' % i, user_id='%050d' % (i % max(users, 1)), user_name='user', user_image='about:blank',
+            title='blog %d' % i, summary='summary of blog %d' % i, content='content ' * 200, content_html='',
+            content_hash='', created_time=now - i) for i in range(blogs)])
+    for model in (User, Blog):
+        objs = rows[model.__table__]
+        for i in range(0, len(objs), 100):
+            sql, args = model._insert_many(objs[i:i+100])
+            fakedb._db.execute(sql, args)
+
+def serve(port, options, directory):
+    '''
+    Child process: the app on port, reading and writing the SQLite stand-in.
+    '''
+    import orm, fakedb
+    from config import configs
+    configs.server.host = '127.0.0.1'
+    configs.server.port = port
+    configs.server.workers = 1
+    configs.logging.level = 'WARNING'        #No access log, it would be measured too
+    configs.search.path = os.path.join(directory, 'search.idx')
+    configs.kdf.iterations = options.kdf_iterations
+    orm.aiomysql = fakedb
+    from models import User, Blog, Comment
+    fakedb.create_tables(User, Blog, Comment)
+    seed(options.users, options.blogs)
+    import app
+    app.application()
+
+def _wait_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit('Server did not start on port %s' % port)
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+_run_id = uuid.uuid4().hex[:8]
+_registered = [0]
+
+def _register_body():
+    _registered[0] += 1
+    n = _registered[0]
+    return json.dumps(dict(email='bench-%s-%d@example.com' % (_run_id, n), name='bench %d' % n, password=_sha1(str(n))))
+
+#name => () returning (method, path, JSON body or None)
+SCENARIOS = dict(
+    index=lambda: ('GET', '/', None),
+    users=lambda: ('GET', '/api/users?limit=20', None),
+    register=lambda: ('POST', '/api/users', _register_body())
+)
+
+@asyncio.coroutine
+def _close(session):
+    r = session.close()        #A coroutine in recent aiohttp versions
+    if inspect.isawaitable(r):
+        yield from r
+
+@asyncio.coroutine
+def _client(session, url, request, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        method, path, body = request()
+        headers = {'Content-Type': 'application/json'} if body is not None else None
+        start = time.monotonic()
+        try:
+            resp = yield from session.request(method, url + path, data=body, headers=headers)
+            data = yield from resp.read()
+            resp.release()
+            failed = resp.status >= 400 or (body is not None and b'"error"' in data)        #API errors come back as 200
+        except (aiohttp.ClientError, OSError):
+            failed = True
+        if failed:
+            errors[0] += 1
+        else:
+            latencies.append(time.monotonic() - start)
+
+@asyncio.coroutine
+def drive(url, name, concurrency, duration, warmup):
+    '''
+    Run a scenario with concurrency clients, the first warmup seconds are not recorded.
+    '''
+    request = SCENARIOS[name]
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+    try:
+        if warmup:
+            yield from asyncio.gather(*[_client(session, url, request, time.monotonic() + warmup, [], [0])
+                for i in range(concurrency)])
+        latencies = []
+        errors = [0]
+        start = time.monotonic()
+        yield from asyncio.gather(*[_client(session, url, request, start + duration, latencies, errors)
+            for i in range(concurrency)])
+        elapsed = time.monotonic() - start
+    finally:
+        yield from _close(session)
+    latencies.sort()
+    return dict(requests=len(latencies), errors=errors[0], rps=len(latencies) / elapsed,
+        p50=benchlib.percentile(latencies, 50) * 1000, p95=benchlib.percentile(latencies, 95) * 1000,
+        p99=benchlib.percentile(latencies, 99) * 1000)
+
+def report(name, r):
+    memory = ''
+    if r.get('rss_kb'):
+        memory = '  rss %7.1f MB (peak %.1f)' % (r['rss_kb'] / 1024.0, r['peak_rss_kb'] / 1024.0)
+    print('%-10s %7d req %5d err %9.1f rps   p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms%s' % (name,
+        r['requests'], r['errors'], r['rps'], r['p50'], r['p95'], r['p99'], memory))
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test of the app.')
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds per scenario not recorded')
+    parser.add_argument('--scenarios', default='index,users,register', help='comma separated, of %s' % ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--users', type=int, default=1000, help='users seeded in the stand-in database')
+    parser.add_argument('--blogs', type=int, default=100, help='blogs seeded in the stand-in database')
+    parser.add_argument('--kdf-iterations', type=int, default=100000, help='PBKDF2 rounds used by registration')
+    parser.add_argument('--url', help='test this running server instead, e.g. http://127.0.0.1:8080')
+    parser.add_argument('--pid', type=int, help='process of the server given by --url, to report its memory')
+    parser.add_argument('--save', help='write the results to this JSON file, e.g. to make a baseline')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='percent worse counted as a regression')
+    options = parser.parse_args()
+    names = [s for s in options.scenarios.split(',') if s]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario: %s' % name)
+
+    child = None
+    pid = options.pid
+    url = options.url
+    directory = tempfile.mkdtemp(prefix='aresou-bench-')
+    if url is None:
+        port = _free_port()
+        child = multiprocessing.Process(target=serve, args=(port, options, directory))
+        child.start()
+        _wait_listening(port)
+        url = 'http://127.0.0.1:%s' % port
+        pid = child.pid
+
+    loop = asyncio.get_event_loop()
+    results = dict()
+    try:
+        print('%s, %s clients, %ss per scenario' % (url, options.concurrency, options.duration))
+        for name in names:
+            r = loop.run_until_complete(drive(url, name, options.concurrency, options.duration, options.warmup))
+            if pid is not None:
+                r['rss_kb'], r['peak_rss_kb'] = benchlib.rss_kb(pid)
+            results[name] = r
+            report(name, r)
+    finally:
+        if child is not None:
+            os.kill(child.pid, signal.SIGTERM)        #Graceful stop, see app.application
+            child.join(30)
+
+    if options.save:
+        benchlib.save(results, options.save)
+    if options.baseline:
+        regressions = benchlib.compare(results, options.baseline, options.tolerance)
+        if regressions:
+            raise SystemExit('Regressions: %s' % ', '.join(regressions))
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ grant select, insert, update, delete on aresou.* to 'root'@'localhost' identifie
 create table users (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
-    `password` varchar(50) not null,
+    `password` varchar(128) not null,
     `admin` bool not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
@@ -30,6 +30,8 @@ create table blogs (
     `title` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `content_html` mediumtext,
+    `content_hash` varchar(40) not null default '',
     `created_time` real not null,
     key `idx_created_time` (`created_time`),
     primary key (`id`)
@@ -42,7 +44,10 @@ create table comments (
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
+    `content_html` mediumtext,
+    `content_hash` varchar(40) not null default '',
     `created_time` real not null,
     key `idx_created_time` (`created_time`),
+    key `idx_blog_created` (`blog_id`, `created_time`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
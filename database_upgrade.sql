@@ -0,0 +1,14 @@
+-- database_upgrade.sql
+-- Used to bring the tables of an install made before content_html to the current schema,
+-- then run `python rendering.py` to fill content_html and content_hash of the existing rows
+
+use aresou;
+
+alter table blogs
+    add column `content_html` mediumtext after `content`,
+    add column `content_hash` varchar(40) not null default '' after `content_html`;
+
+alter table comments
+    add column `content_html` mediumtext after `content`,
+    add column `content_hash` varchar(40) not null default '' after `content_html`,
+    add key `idx_blog_created` (`blog_id`, `created_time`);
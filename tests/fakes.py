@@ -0,0 +1,134 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+fakes.py
+aiomysql stand-in for the tests, recording every statement instead of talking to MySQL:
+    orm.aiomysql = fakes
+    db = fakes.reset(respond=lambda host, sql, args: rows)
+    run(orm.create_pool(loop, user='', password='', db=''))
+respond gives the rows of a select, or the rows affected (an int) of a write; fail is raised by every execute.
+'''
+
+import asyncio
+
+class OperationalError(Exception):
+    pass
+
+class IntegrityError(Exception):
+    pass
+
+class DictCursor(object):
+    pass
+
+class SSDictCursor(DictCursor):
+    pass
+
+class Database(object):
+    def __init__(self, respond=None, fail=None):
+        self.respond = respond or (lambda host, sql, args: [])
+        self.fail = fail
+        self.statements = []        #(host, sql, args) in the order they ran
+        self.calls = []        #(host, 'begin' | 'commit' | 'rollback')
+        self.released = 0
+
+    def queries(self, prefix='select'):
+        return [s for s in self.statements if s[1].lstrip().lower().startswith(prefix)]
+
+db = Database()
+
+def reset(respond=None, fail=None):
+    global db
+    db = Database(respond, fail)
+    return db
+
+class Cursor(object):
+    def __init__(self, host):
+        self.host = host
+        self.rowcount = 0
+        self._rows = []
+
+    @asyncio.coroutine
+    def execute(self, sql, args=None):
+        db.statements.append((self.host, sql, list(args or ())))
+        if db.fail is not None:
+            raise db.fail
+        rs = db.respond(self.host, sql, args)
+        if isinstance(rs, int):
+            self._rows, self.rowcount = [], rs
+        else:
+            self._rows = [dict(r) for r in rs or ()]
+            self.rowcount = len(self._rows)
+
+    @asyncio.coroutine
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    @asyncio.coroutine
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    @asyncio.coroutine
+    def close(self):
+        pass
+
+class Connection(object):
+    def __init__(self, host):
+        self.host = host
+
+    @asyncio.coroutine
+    def cursor(self, factory=None):
+        return Cursor(self.host)
+
+    @asyncio.coroutine
+    def begin(self):
+        db.calls.append((self.host, 'begin'))
+
+    @asyncio.coroutine
+    def commit(self):
+        db.calls.append((self.host, 'commit'))
+
+    @asyncio.coroutine
+    def rollback(self):
+        db.calls.append((self.host, 'rollback'))
+
+    @asyncio.coroutine
+    def ping(self):
+        pass
+
+class Pool(object):
+    def __init__(self, host, maxsize):
+        self.host = host
+        self.maxsize = maxsize
+
+    @asyncio.coroutine
+    def acquire(self):
+        return Connection(self.host)
+
+    def release(self, conn):
+        db.released += 1
+
+    def close(self):
+        pass
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        pass
+
+@asyncio.coroutine
+def create_pool(host='localhost', maxsize=10, **kw):
+    return Pool(host, maxsize)
+
+def run(coro):
+    '''
+    Run coro to completion on a new event loop, made the current one for the Loader and the pools.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
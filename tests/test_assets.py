@@ -0,0 +1,66 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_assets.py
+Static files are served with the type of their original extension, precompressed when the client
+accepts gzip, and only fingerprinted files are cached forever.
+'''
+
+import os, sys, gzip, tempfile, shutil, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+from aiohttp.test_utils import make_mocked_request
+
+import fakes
+import executor
+import assets
+
+CSS = b'body { color: black; }\n' * 10
+
+class AssetsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'css'))
+        with open(os.path.join(self.path, 'css', 'site.css'), 'wb') as f:
+            f.write(CSS)
+        assets.build(self.path)
+        self.assets = assets.Assets(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        executor.shutdown()
+
+    def get(self, name, gzip_ok=False):
+        headers = {'Accept-Encoding': 'gzip'} if gzip_ok else {}
+        request = make_mocked_request('GET', '/static/' + name, headers=headers, match_info={'path': name})
+        return fakes.run(self.assets.handle(request))
+
+    def test_source_file(self):
+        r = self.get('css/site.css')
+        self.assertEqual(r.body, CSS)
+        self.assertEqual(r.content_type, 'text/css')
+        self.assertEqual(r.headers['Cache-Control'], 'public, max-age=300')
+
+    def test_fingerprinted(self):
+        name = self.assets.manifest['css/site.css']
+        r = self.get(name, gzip_ok=True)
+        self.assertEqual(gzip.decompress(r.body), CSS)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(r.content_type, 'text/css')
+        self.assertIn('immutable', r.headers['Cache-Control'])
+
+    def test_gz_by_name(self):
+        r = self.get(self.assets.manifest['css/site.css'] + '.gz')
+        self.assertEqual(gzip.decompress(r.body), CSS)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(r.content_type, 'text/css')
+
+    def test_manifest(self):
+        r = self.get('dist/manifest.json')
+        self.assertEqual(r.content_type, 'application/json')
+        self.assertNotIn('immutable', r.headers['Cache-Control'])
+
+if __name__ == '__main__':
+    unittest.main()
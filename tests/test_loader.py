@@ -0,0 +1,73 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_loader.py
+The authors of a page are looked up with one batched query through the request Loader, not one per row.
+'''
+
+import os, sys, asyncio, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import fakes
+import orm
+import handlers
+
+def user_row(uid):
+    return dict(id=uid, email='%s@example.com' % uid, password='x', admin=False, name='name-%s' % uid, image='', created_time=1.0)
+
+def post_row(i, uid, **kw):
+    row = dict(id='c%d' % i, blog_id='b1', user_id=uid, user_name='old-%s' % uid, user_image='', content='hi',
+        content_html='<p>hi</p>', content_hash='', created_time=float(i))
+    row.update(kw)
+    return row
+
+def respond(host, sql, args):
+    if 'from `users`' in sql:
+        return [user_row(uid) for uid in args]
+    if 'from `blogs`' in sql:
+        return [post_row(0, 'u0', id='b1', title='t', summary='')]
+    if 'from `comments`' in sql:
+        return [post_row(i, 'u%d' % (i % 3)) for i in range(1, 11)]
+    return []
+
+class LoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.aiomysql, orm.aiomysql = orm.aiomysql, fakes
+        self.db = fakes.reset(respond)
+
+    def tearDown(self):
+        orm.aiomysql = self.aiomysql
+
+    def get_blog(self, loader):
+        @asyncio.coroutine
+        def run():
+            yield from orm.create_pool(asyncio.get_event_loop(), user='', password='', db='')
+            token = orm.set_loader(orm.Loader()) if loader else None
+            try:
+                return (yield from handlers.get_blog('b1'))
+            finally:
+                if token is not None:
+                    orm.reset_loader(token)
+                yield from orm.close_pool()
+        return fakes.run(run())
+
+    def test_authors_batched(self):
+        r = self.get_blog(loader=True)
+        self.assertEqual(len(r['comments']), 10)
+        self.assertEqual(sorted(r['authors']), ['u0', 'u1', 'u2'])
+        self.assertEqual(r['authors']['u1'].name, 'name-u1')
+        #The blog, its comments, then every author at once
+        self.assertEqual(len(self.db.queries()), 3)
+        users = [s for s in self.db.queries() if 'from `users`' in s[1]]
+        self.assertEqual(len(users), 1)
+        self.assertEqual(users[0][2], ['u0', 'u1', 'u2'])
+
+    def test_without_loader(self):
+        r = self.get_blog(loader=False)
+        self.assertEqual(sorted(r['authors']), ['u0', 'u1', 'u2'])
+        self.assertEqual(len([s for s in self.db.queries() if 'from `users`' in s[1]]), 3)
+
+if __name__ == '__main__':
+    unittest.main()
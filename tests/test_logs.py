@@ -0,0 +1,45 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_logs.py
+Setting logging up again replaces the queue and the writer thread instead of stacking them,
+and records dropped on a full queue are counted.
+'''
+
+import os, sys, logging, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import logs
+
+class SetupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.saved = self.root.handlers[:], self.root.level
+
+    def tearDown(self):
+        logs.stop()
+        self.root.handlers[:], level = self.saved
+        self.root.setLevel(level)
+
+    def test_idempotent(self):
+        first = logs.setup()
+        second = logs.setup()
+        self.assertEqual(len(self.root.handlers), 1)
+        self.assertIsInstance(self.root.handlers[0], logs.DroppingQueueHandler)
+        self.assertIsNone(first._thread)        #Stopped by the second setup
+        self.assertEqual(len(second.handlers), len(first.handlers))
+        self.assertEqual(len([f for f in logs.sql_logger.filters if isinstance(f, logs.SamplingFilter)]), 1)
+
+    def test_dropped(self):
+        logs.setup(queue_size=1)
+        logs.stop()        #Nothing takes records off the queue any more
+        before = logs.DROPPED._values.get((), 0)
+        for i in range(3):
+            logging.warning('record %s', i)
+        self.assertEqual(self.root.handlers[0].dropped, 2)
+        self.assertEqual(logs.DROPPED._values.get(()) - before, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_orm.py
+Statements sent by the orm, against the recording pools of fakes.py: chunked saveMany and upserts,
+RowIterator batches, invalidation of the cached counts and loads, and reads routed to replicas.
+'''
+
+import os, sys, asyncio, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import fakes
+import orm
+from models import User
+
+def user_row(uid):
+    return dict(id=uid, email='%s@example.com' % uid, password='x', admin=False, name=uid, image='', created_time=1.0)
+
+def with_pool(body, **kw):
+    '''
+    Run the coroutine function body on pools of fakes created with kw.
+    '''
+    @asyncio.coroutine
+    def run():
+        yield from orm.create_pool(asyncio.get_event_loop(), user='', password='', db='', **kw)
+        try:
+            return (yield from body())
+        finally:
+            yield from orm.close_pool()
+    return fakes.run(run())
+
+class OrmTest(unittest.TestCase):
+    def setUp(self):
+        self.aiomysql, orm.aiomysql = orm.aiomysql, fakes
+
+    def tearDown(self):
+        orm.aiomysql = self.aiomysql
+
+class SaveManyTest(OrmTest):
+    def save(self, upsert):
+        self.db = fakes.reset(lambda host, sql, args: len(args) // len(User.__mappings__))
+        users = [User(**user_row('u%d' % i)) for i in range(5)]
+        return with_pool(lambda: User.saveMany(users, chunkSize=2, upsert=upsert))
+
+    def test_chunks(self):
+        counts = self.save(upsert=False)
+        self.assertEqual(counts, [2, 2, 1])
+        self.assertEqual([len(args) for host, sql, args in self.db.statements], [14, 14, 7])
+        self.assertEqual([c for h, c in self.db.calls], ['begin', 'commit'] * 3)        #A transaction per chunk
+        self.assertEqual(self.db.released, 1)        #On one connection
+        self.assertNotIn('on duplicate key update', self.db.statements[0][1])
+
+    def test_upsert(self):
+        self.save(upsert=True)
+        self.assertTrue(all(sql.endswith(orm.compile_sql(User.__upsert__)) for host, sql, args in self.db.statements))
+
+class RowIteratorTest(OrmTest):
+    def setUp(self):
+        super(RowIteratorTest, self).setUp()
+        self.db = fakes.reset(lambda host, sql, args: [user_row('u%d' % i) for i in range(5)])
+
+    def iterate(self, count=None, **kw):
+        @asyncio.coroutine
+        def body():
+            it = User.iterAll(batch=2, **kw)
+            objs = []
+            try:
+                while count is None or len(objs) < count:
+                    objs.append((yield from it.__anext__()))
+            except StopAsyncIteration:
+                pass
+            yield from it.close()
+            return objs
+        return with_pool(body)
+
+    def test_all_rows(self):
+        users = self.iterate()
+        self.assertEqual([u.id for u in users], ['u0', 'u1', 'u2', 'u3', 'u4'])
+        self.assertIsInstance(users[0], User)
+        self.assertEqual(len(self.db.statements), 1)
+        self.assertEqual(self.db.released, 1)
+
+    def test_records_and_early_close(self):
+        users = self.iterate(count=1, records=True)
+        self.assertEqual(users[0].id, 'u0')
+        self.assertIsInstance(users[0], User.__record__)
+        self.assertEqual(self.db.released, 1)
+
+class CacheTest(OrmTest):
+    def test_count_invalidated_by_write(self):
+        db = fakes.reset(lambda host, sql, args: [dict(_num_=3)] if 'count(*)' in sql else 1)
+
+        @asyncio.coroutine
+        def body():
+            counts = [(yield from User.count(ttl=60)), (yield from User.count(ttl=60))]
+            yield from User(**user_row('u9')).save()
+            counts.append((yield from User.count(ttl=60)))
+            return counts
+        User.__counts__.clear()
+        self.assertEqual(with_pool(body), [3, 3, 3])
+        self.assertEqual(len(db.queries()), 2)        #Once cached, once after the insert
+
+    def test_load_forgotten_after_write(self):
+        db = fakes.reset(lambda host, sql, args: [user_row(a) for a in args] if sql.startswith('select') else 1)
+
+        @asyncio.coroutine
+        def body():
+            orm.set_loader(orm.Loader())
+            user = yield from User.load('u1')
+            yield from User.load('u1')
+            yield from user.update()
+            yield from User.load('u1')
+        with_pool(body)
+        self.assertEqual(len(db.queries()), 2)
+
+    def test_statement_per_shape(self):
+        db = fakes.reset()
+
+        @asyncio.coroutine
+        def body():
+            yield from User.findAll('name=?', ['a'], limit=5)
+            yield from User.findAll('name=?', ['b'], limit=10)
+        with_pool(body)
+        (h1, sql1, args1), (h2, sql2, args2) = db.statements
+        self.assertIs(sql1, sql2)        #Built and compiled once
+        self.assertEqual([args1, args2], [['a', 5], ['b', 10]])
+
+class ReplicaTest(OrmTest):
+    def reads(self, body, respond=None):
+        self.db = fakes.reset(respond or (lambda host, sql, args: 1 if sql.startswith('update') else []))
+        with_pool(body, replicas=[dict(host='replica')], health_interval=3600)
+        return [host for host, sql, args in self.db.queries()]
+
+    def test_pinned_after_write(self):
+        @asyncio.coroutine
+        def body():
+            yield from orm.select('select 1', None)
+            yield from orm.execute('update `users` set `name`=?', ['a'])
+            yield from orm.select('select 2', None)
+            yield from orm.select('select 3', None, primary=False)
+            orm.unpin()        #The next request
+            yield from orm.select('select 4', None)
+        self.assertEqual(self.reads(body), ['replica', 'localhost', 'replica', 'replica'])
+
+    def test_failed_replica(self):
+        def respond(host, sql, args):
+            if host == 'replica':
+                raise fakes.OperationalError('gone')
+            return []
+
+        @asyncio.coroutine
+        def body():
+            yield from orm.select('select 1', None)
+            yield from orm.select('select 2', None)
+        self.assertEqual(self.reads(body, respond), ['replica', 'localhost', 'localhost'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_pagination.py
+findPage walks a filtered table page by page without repeating or skipping rows,
+against the SQLite stand-in of bench/fakedb.py. Cursors sent back by clients are checked.
+'''
+
+import os, sys, json, base64, asyncio, unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fakes
+import fakedb
+import orm
+from models import Blog
+
+class PaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.aiomysql, orm.aiomysql = orm.aiomysql, fakedb
+        fakedb.create_tables(Blog)
+
+    def tearDown(self):
+        orm.aiomysql = self.aiomysql
+
+    def pages(self, blogs, where=None, args=None, limit=4):
+        '''
+        Save blogs, then the ids of every page of findPage until the cursor runs out.
+        '''
+        @asyncio.coroutine
+        def run():
+            yield from orm.create_pool(asyncio.get_event_loop(), user='', password='', db='')
+            try:
+                yield from Blog.saveMany(blogs)
+                pages = []
+                cursor = None
+                while len(pages) < 10:        #A cursor that does not move on would loop forever
+                    objs, cursor = yield from Blog.findPage(where, args, cursor=cursor, limit=limit)
+                    pages.append([b.id for b in objs])
+                    if cursor is None:
+                        break
+                return pages
+            finally:
+                yield from orm.close_pool()
+        return fakes.run(run())
+
+    def blogs(self, users, n):
+        return [Blog(id='%s%02d' % (uid, i), user_id=uid, user_name=uid, user_image='', title='t', summary='',
+            content='hi', created_time=float(i)) for uid in users for i in range(n)]
+
+    def test_or_filter(self):
+        pages = self.pages(self.blogs('abc', 5), 'user_id=? or user_id=?', ['a', 'b'])
+        self.assertEqual([len(p) for p in pages], [4, 4, 2])
+        ids = [i for p in pages for i in p]
+        self.assertEqual(sorted(ids), ['a%02d' % i for i in range(5)] + ['b%02d' % i for i in range(5)])
+
+    def test_full_last_page(self):
+        pages = self.pages(self.blogs('ab', 4), limit=4)
+        self.assertEqual(pages, [['b03', 'a03', 'b02', 'a02'], ['b01', 'a01', 'b00', 'a00']])
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        for values in [(1.5, 'abc'), ('2016-01-01', 'x' * 50), (0, '')]:
+            cursor = orm.encode_cursor(*values)
+            self.assertEqual(orm.decode_cursor(cursor), list(values))
+            self.assertRegex(cursor, r'^[A-Za-z0-9_=-]+$')        #Safe in a query string
+
+    def test_tampered(self):
+        def encode(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+        for cursor in ['not base64!', 'AAAA', encode({'a': 1}), encode([1, [2]]), encode([1, {'a': 1}]),
+                encode([None, 'x']), encode('text'), '\u00e9']:
+            with self.assertRaises(ValueError):
+                orm.decode_cursor(cursor)
+
+    def test_tampered_page(self):
+        with self.assertRaises(ValueError):
+            fakes.run(Blog.findPage(cursor=orm.encode_cursor(1.0, 'x', 'y')))        #Not a (key, primary key) pair
+
+if __name__ == '__main__':
+    unittest.main()
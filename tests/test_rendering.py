@@ -0,0 +1,58 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_rendering.py
+The backfill writes the rendered columns of the rows it read, and leaves alone a row written in between,
+against the SQLite stand-in of bench/fakedb.py.
+'''
+
+import os, sys, asyncio, unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'www'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fakes
+import fakedb
+import orm
+import executor
+import rendering
+from models import Blog
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.aiomysql, orm.aiomysql = orm.aiomysql, fakedb
+        fakedb.create_tables(Blog)
+
+    def tearDown(self):
+        orm.aiomysql = self.aiomysql
+        executor.shutdown()
+
+    def test_concurrent_edit_kept(self):
+        @asyncio.coroutine
+        def run():
+            yield from orm.create_pool(asyncio.get_event_loop(), user='', password='', db='')
+            try:
+                for i in range(3):        #Rows of an install older than content_html
+                    yield from orm.execute('insert into `blogs` (`id`, `user_id`, `user_name`, `user_image`, `title`, '
+                        '`summary`, `content`, `content_hash`, `created_time`) values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        ['b%d' % i, 'u', 'u', '', 't', '', 'old %d' % i, '', float(i)])
+                rows = yield from Blog.findAll(orderBy='id')
+                edited = yield from Blog.find('b1')
+                edited.title = 'edited'
+                edited.content = 'new'
+                yield from edited.update()
+                written = yield from rendering._backfill_batch(Blog, rows)
+                return written, (yield from Blog.findAll(orderBy='id'))
+            finally:
+                yield from orm.close_pool()
+        written, blogs = fakes.run(run())
+        self.assertEqual(written, 2)
+        self.assertEqual([b.content_html for b in blogs], [rendering.to_html(t) for t in ('old 0', 'new', 'old 2')])
+        self.assertEqual([b.summary for b in blogs], ['old 0', 'new', 'old 2'])
+        self.assertEqual(blogs[1].title, 'edited')
+        self.assertEqual(blogs[1].content_hash, rendering.content_hash('new'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_responses.py
+A GET or HEAD carrying the ETag of the body gets a 304, other methods always get the body.
+Every compressed representation has its own ETag, and is compressed once for a cached page.
+'''
+
+import os, sys, gzip, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+from aiohttp.test_utils import make_mocked_request
+from responses import make_response, make_etag
+
+BODY = b'<html>hello</html>'
+
+class ETagTest(unittest.TestCase):
+    def respond(self, method, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return make_response(make_mocked_request(method, '/', headers=headers), BODY, 'text/html')
+
+    def test_not_modified(self):
+        etag = self.respond('GET').headers['ETag']
+        self.assertEqual(etag, make_etag(BODY))
+        self.assertEqual(self.respond('GET', etag).status, 304)
+        self.assertEqual(self.respond('HEAD', etag).status, 304)
+        self.assertEqual(self.respond('GET', 'W/' + etag).status, 304)
+
+    def test_modified(self):
+        r = self.respond('GET', '"other"')
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.body, BODY)
+
+    def test_post_gets_body(self):
+        r = self.respond('POST', self.respond('GET').headers['ETag'])
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.body, BODY)
+
+    def test_compressed(self):
+        body = BODY * 200
+        request = make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+        variants = dict()
+        r = make_response(request, body, 'text/html', variants=variants)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(r.body), body)
+        self.assertTrue(r.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(list(variants), ['gzip'])
+        variants['gzip'] = b'cached'
+        self.assertEqual(make_response(request, body, 'text/html', variants=variants).body, b'cached')
+        revalidate = make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']})
+        self.assertEqual(make_response(revalidate, body, 'text/html').status, 304)
+        plain = make_mocked_request('GET', '/', headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(make_response(plain, body, 'text/html').status, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_search.py
+BM25 ranking of the search index after documents are updated or removed.
+'''
+
+import os, sys, struct, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+from search import SearchIndex
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'search.idx')
+        self.index = SearchIndex(self.path)
+        self.index.add('blogs:1', 'Python', [('python asyncio', 1)])
+        self.index.add('blogs:2', 'Swift', [('swift python', 1)])
+        self.index.add('blogs:3', 'Rust', [('rust', 1)])
+        self.index.save()        #Documents now live in the mmap'ed base
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_remove(self):
+        self.index.remove('blogs:2')
+        results = self.index.search('python')
+        self.assertEqual([key for key, title, score in results], ['blogs:1'])
+        self.assertTrue(all(score > 0 for key, title, score in results))
+
+    def test_update(self):
+        self.index.add('blogs:1', 'Python', [('python asyncio coroutines', 1)])
+        self.index.add('blogs:2', 'Swift', [('swift python ios', 1)])
+        results = self.index.search('python')
+        self.assertEqual(sorted(key for key, title, score in results), ['blogs:1', 'blogs:2'])
+        self.assertTrue(all(score > 0 for key, title, score in results))
+
+    def test_update_away(self):
+        self.index.add('blogs:2', 'Swift', [('swift only', 1)])
+        self.index.add('blogs:3', 'Rust', [('rust python', 1)])
+        results = self.index.search('python')
+        self.assertEqual(sorted(key for key, title, score in results), ['blogs:1', 'blogs:3'])
+        self.assertTrue(all(score > 0 for key, title, score in results))
+
+    def test_remove_all_but_one(self):
+        self.index.remove('blogs:1')
+        self.index.remove('blogs:3')
+        results = self.index.search('python swift')
+        self.assertEqual(len(results), 1)
+        self.assertGreater(results[0][2], 0)
+
+    def test_little_endian(self):
+        offset, count = self.index._base['rust']
+        with open(self.path, 'rb') as f:
+            f.seek(self.index._postings_start + offset)
+            raw = f.read(count * 8)
+        self.assertEqual(list(self.index.postings('rust')), list(struct.iter_unpack('<II', raw)))
+        self.assertEqual(struct.unpack('<I', raw[:4])[0], 2)        #Docno of blogs:3
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+test_transaction.py
+A transaction whose flush fails on commit, or whose block raises, is rolled back and its connection given back.
+Records queued in a transaction are written as their models.
+'''
+
+import os, sys, asyncio, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+
+import fakes
+import orm
+from models import User
+
+def user():
+    return User(id='1', email='a@example.com', password='x', admin=False, name='a', image='', created_time=1.0)
+
+@asyncio.coroutine
+def in_transaction(body):
+    '''
+    Run body(tx) the way `async with orm.transaction() as tx` does, on a pool of fakes.
+    '''
+    yield from orm.create_pool(asyncio.get_event_loop(), user='', password='', db='')
+    try:
+        tx = orm.transaction()
+        yield from tx.__aenter__()
+        try:
+            body(tx)
+        except BaseException:
+            if not (yield from tx.__aexit__(*sys.exc_info())):
+                raise
+        else:
+            yield from tx.__aexit__(None, None, None)
+    finally:
+        yield from orm.close_pool()
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.aiomysql, orm.aiomysql = orm.aiomysql, fakes
+        self.notified = []
+        orm.add_listener(lambda action, model: self.notified.append(action))
+
+    def tearDown(self):
+        orm.aiomysql = self.aiomysql
+        orm._listeners.pop()
+
+    def test_failed_commit_rolls_back(self):
+        db = fakes.reset(fail=fakes.IntegrityError('Duplicate entry for key PRIMARY'))
+        with self.assertRaises(fakes.IntegrityError):
+            fakes.run(in_transaction(lambda tx: tx.save(user())))
+        self.assertEqual([c for h, c in db.calls], ['begin', 'rollback'])
+        self.assertEqual(db.released, 1)
+        self.assertEqual(self.notified, [])
+
+    def test_error_in_block_rolls_back(self):
+        db = fakes.reset()
+        def body(tx):
+            tx.save(user())
+            raise KeyError('in the block')
+        with self.assertRaises(KeyError):
+            fakes.run(in_transaction(body))
+        self.assertEqual([c for h, c in db.calls], ['begin', 'rollback'])
+        self.assertEqual(db.statements, [])        #Queued writes are dropped, not flushed
+        self.assertEqual(db.released, 1)
+        self.assertEqual(self.notified, [])
+
+    def test_update_record(self):
+        db = fakes.reset(lambda host, sql, args: 1)
+        record = User.__record__(**user())
+        fakes.run(in_transaction(lambda tx: tx.update(record)))
+        self.assertEqual([c for h, c in db.calls], ['begin', 'commit'])
+        host, sql, args = db.statements[0]
+        self.assertEqual(sql, orm.compile_sql(User.__update__))
+        self.assertEqual(args[-1], '1')
+        self.assertEqual(self.notified, ['update'])
+
+if __name__ == '__main__':
+    unittest.main()
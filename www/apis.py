@@ -2,13 +2,30 @@
 __author__ = 'aresowj'
 
 '''
-orm.py
-Database connection module for MySQL.
-Using aoimysql to keep implementing async methods in all program layers.
+apis.py
+API errors returned to the client as JSON.
 '''
 
-import logging
+class APIError(Exception):
+    '''
+    The base APIError which contains error(required), data(optional) and message(optional).
+    '''
+    def __init__(self, error, data='', message=''):
+        super(APIError, self).__init__(message)
+        self.error = error
+        self.data = data
+        self.message = message
 
-import asyncio, aiomysql
-from coroweb import get, post
+class APIValueError(APIError):
+    '''
+    Indicate the input value has error or invalid. The data specifies the error field of input form.
+    '''
+    def __init__(self, field, message=''):
+        super(APIValueError, self).__init__('value:invalid', field, message)
 
+class APIBusyError(APIError):
+    '''
+    Indicate the server is too busy to take the request now, the client may retry later.
+    '''
+    def __init__(self, message=''):
+        super(APIBusyError, self).__init__('server:busy', '', message)
@@ -10,20 +10,39 @@ Using asyncio and aiohttp to contruct the basement.
 import logging
 logging.basicConfig(level=logging.INFO)    #Reporting events occur during normal opeartion.
 
-import asyncio, os, json, time
+import asyncio, os, time, zlib, signal
 from datetime import datetime
 
 from aiohttp import web
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from config import configs
 import orm
+import logs
+import metrics
+import serializer
+import assets
+import executor
+import rendering
+from cache import PageCache
+from search import SearchIndex, DEFAULT_PATH
+from responses import make_response, accepted_encodings
 from coroweb import add_routes, add_static
+from prefork import Supervisor
+from profiling import Sampler
+from handlers import COOKIE_NAME
+
+REQUEST_TIME = metrics.Histogram('http_request_seconds', 'Request latency by route.', ('method', 'route'))
+REQUEST_PARTS = metrics.Histogram('http_request_part_seconds', 'Request time spent in the database, rendering and the handler.', ('route', 'part'))
+IN_FLIGHT = metrics.Gauge('http_requests_in_flight', 'Requests being handled.')
 
 def init_jinja2(app, **kw):
     """
     Initialize jinja2 by creating an Environment.
+    For production: auto_reload=False stops stat'ing template files on every render,
+    bytecode_cache keeps compiled templates on disk for the next workers to start from,
+    precompile compiles all the templates now instead of on their first request.
     """
     logging.info('Initializing jinja2...')
     options = dict(
@@ -41,6 +60,12 @@ def init_jinja2(app, **kw):
 
     logging.info('Jinja2 template path set to: %s' % path)
     
+    cache_path = kw.get('bytecode_cache', None)
+    if cache_path is not None:
+        os.makedirs(cache_path, exist_ok=True)
+        logging.info('Jinja2 bytecode cache set to: %s' % cache_path)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_path)
+    
     env = Environment(loader=FileSystemLoader(path), **options)
     
     filters = kw.get('filters', None)
@@ -49,6 +74,17 @@ def init_jinja2(app, **kw):
         for name, f in filters.items():
             env.filters[name] = f
     
+    functions = kw.get('globals', None)
+    
+    if functions is not None:
+        env.globals.update(functions)
+    
+    if kw.get('precompile', False):
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)        #Kept in the environment cache, and the bytecode cache if any
+        logging.info('Jinja2 precompiled %s templates' % len(names))
+    
     app['__templating__'] = env        #Add jinja2 to the app for templating
 
 def datetime_filter(t):
@@ -73,23 +109,170 @@ def datetime_filter(t):
 @asyncio.coroutine
 def logger_factory(app, handler):
     """
-    Middleware for logging.
+    Middleware for logging: one structured access record per request, see logs.AccessFormatter.
     """
     
     @asyncio.coroutine
     def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        return (yield from handler(request))
+        start = time.monotonic()
+        status = 500
+        size = None
+        try:
+            resp = yield from handler(request)
+            status = resp.status
+            size = resp.content_length
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            logs.access_logger.info('access', extra=dict(access=dict(method=request.method, path=request.path,
+                status=status, latency=round(time.monotonic() - start, 6), bytes=size)))
     return logger
 
+def route_name(request):
+    """
+    Path pattern of the route matched by request, e.g. /blog/{id}, so metrics are per route and not per URL.
+    """
+    resource = getattr(request.match_info.route, 'resource', None)
+    if resource is None:
+        return 'unmatched'
+    info = resource.get_info()
+    return info.get('path') or info.get('formatter') or info.get('prefix') or 'unmatched'
+
+@asyncio.coroutine
+def instrument_factory(app, handler):
+    """
+    Middleware for metrics: latency per route split into database, render and handler time
+    (see metrics.span), requests in flight, and a cProfile of a sample of the requests.
+    """
+    sampler = app['__profiler__']
+
+    @asyncio.coroutine
+    def instrument(request):
+        route = route_name(request)
+        spans, token = metrics.start_spans()
+        profiled = sampler.sample()
+        IN_FLIGHT.inc()
+        start = time.monotonic()
+        try:
+            return (yield from handler(request))
+        finally:
+            elapsed = time.monotonic() - start
+            IN_FLIGHT.dec()
+            if profiled:
+                sampler.finish('%s %s' % (request.method, route))
+            metrics.reset_spans(token)
+            db = spans.get('db', 0.0)
+            render = spans.get('render', 0.0)
+            REQUEST_TIME.observe(elapsed, request.method, route)
+            REQUEST_PARTS.observe(db, route, 'db')
+            REQUEST_PARTS.observe(render, route, 'render')
+            REQUEST_PARTS.observe(max(elapsed - db - render, 0.0), route, 'handler')
+    return instrument
+
+@asyncio.coroutine
+def loader_factory(app, handler):
+    """
+    Middleware giving every request its own orm.Loader, so Model.load batches and memoizes per request,
+    and its own replica pinning, so only the rest of a request that wrote reads from the primary.
+    """
+    @asyncio.coroutine
+    def loader(request):
+        pin = orm.unpin()
+        token = orm.set_loader(orm.Loader())
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.reset_loader(token)
+            orm.reset_pin(pin)
+    return loader
+
+def page_key(request):
+    """
+    Key of a cached page: route, query and the session cookie, so signed-in users never share pages.
+    """
+    return (request.path, request.query_string, request.cookies.get(COOKIE_NAME, ''))
+
+def page_response(request, page):
+    return make_response(request, page.body, page.content_type, page.etag, page.last_modified, page.variants)
+
+@asyncio.coroutine
+def cache_factory(app, handler):
+    """
+    Middleware serving GET requests from the page cache, skipping the handler and rendering.
+    Pages are stored by response_factory for template results carrying '__cache__' tags.
+    """
+    @asyncio.coroutine
+    def cache(request):
+        if request.method == 'GET':
+            page = app['__pagecache__'].get(page_key(request))
+            if page is not None:
+                return page_response(request, page)
+        return (yield from handler(request))
+    return cache
+
+@asyncio.coroutine
+def stream_json(request, r):
+    """
+    Send a large JSON result in chunks instead of encoding it whole.
+    """
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json;charset=utf-8'
+    yield from resp.prepare(request)
+    for chunk in serializer.iter_dumps(r, configs.json.chunk):
+        resp.write(chunk)
+        yield from resp.drain()
+    yield from resp.write_eof()
+    return resp
+
+@asyncio.coroutine
+def stream_template(request, template, r):
+    """
+    Render with generate() and send the page while it renders: the chunk closing the head
+    is flushed at once so the browser starts fetching assets, then every stream_chunk characters.
+    Gzip is done here with a sync flush per chunk, aiohttp's compression would hold the chunks back.
+    """
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html;charset=utf-8'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    gz = None
+    if 'gzip' in accepted_encodings(request.headers.get('Accept-Encoding', '')):
+        gz = zlib.compressobj(configs.compress.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)        #gzip container
+        resp.headers['Content-Encoding'] = 'gzip'
+    yield from resp.prepare(request)
+
+    def encode(text, mode=zlib.Z_SYNC_FLUSH):
+        data = text.encode('utf-8')
+        if gz is None:
+            return data
+        return gz.compress(data) + gz.flush(mode)        #Everything written so far can be decoded
+
+    limit = configs.templating.stream_chunk
+    buf = []
+    size = 0
+    head_sent = False
+    for piece in template.generate(**r):
+        buf.append(piece)
+        size += len(piece)
+        if size >= limit or (not head_sent and '</head>' in piece):
+            head_sent = True
+            resp.write(encode(''.join(buf)))
+            yield from resp.drain()
+            buf = []
+            size = 0
+    resp.write(encode(''.join(buf), zlib.Z_FINISH))
+    yield from resp.write_eof()
+    return resp
+
 @asyncio.coroutine
 def response_factory(app, handler):
     """
     Middleware for response.
+    Template results with a true '__stream__' are sent while rendering (not cached), see stream_template.
     """
     @asyncio.coroutine
     def response(request):
-        logging.info('Response handler...')
         r = yield from handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -106,19 +289,29 @@ def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
+                with metrics.span('render'):
+                    if serializer.count_items(r) > configs.json.stream_items:
+                        return (yield from stream_json(request, r))
+                    body = serializer.dumps(r)
+                return make_response(request, body, 'application/json;charset=utf-8')
             else:
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
-        if isinstance(r, int) and t >= 100 and t < 600:
-            return web.Response(t)
+                if r.get('__stream__'):
+                    with metrics.span('render'):        #Includes sending, the page is rendered while it is sent
+                        return (yield from stream_template(request, app['__templating__'].get_template(template), r))
+                with metrics.span('render'):
+                    body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                tags = r.get('__cache__')
+                if tags is not None and request.method == 'GET':
+                    #Tags are the tables the page is rendered from
+                    page = app['__pagecache__'].set(page_key(request), body, 'text/html;charset=utf-8', tags)
+                    return page_response(request, page)
+                return make_response(request, body, 'text/html;charset=utf-8')
+        if isinstance(r, int) and r >= 100 and r < 600:
+            return web.Response(status=r)
         if isinstance(r, tuple) and len(r) == 2:
             t, m = r
             if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(t, str(m))
+                return web.Response(status=t, reason=str(m))
         #default:
         resp = web.Response(body=str(r).encode('utf-8'))
         resp.content_type = 'text/plain;charset=utf-8'
@@ -127,27 +320,93 @@ def response_factory(app, handler):
     return response
 
 @asyncio.coroutine
-def init(loop):
+def reload_search(app):
+    """
+    Reopen the search index whenever the file is replaced, e.g. rebuilt by `python search.py`.
+    """
+    index = app['__search__']
+    while True:
+        yield from asyncio.sleep(configs.search.reload_interval)
+        if index.changed():
+            index.reopen()
+
+@asyncio.coroutine
+def init(loop, sock=None):
     """
     Initiation function for the whole app.
-    Using Coroutine at this point.
+    Using Coroutine at this point. Serves on sock when given, e.g. the socket shared by prefork workers.
     """
     
     yield from orm.create_pool(loop=loop, **configs.db)
+    executor.setup(**configs.executor)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory
+        logger_factory, instrument_factory, cache_factory, loader_factory, response_factory
         ])    #Passing the main loop and middlewares to app.
-    init_jinja2(app, filters=dict(datetime=datetime_filter))    #Initialize jinja2
+    app['__profiler__'] = Sampler(**configs.profiling)
+    if configs.assets.build:
+        assets.build()        #Fingerprint static files before the manifest is loaded
+    static = assets.Assets()
+    init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=static.url, content_html=rendering.content_html), **configs.templating)    #Initialize jinja2
+    app['__pagecache__'] = PageCache(**configs.pagecache)
+    orm.add_listener(lambda action, model: app['__pagecache__'].invalidate(model.__table__))    #Drop pages rendered from a written table
+    app['__search__'] = SearchIndex.open(configs.search.path or DEFAULT_PATH)
+    orm.add_listener(app['__search__'].on_change)        #Index the writes of this process
+    app['__search_reload__'] = loop.create_task(reload_search(app))
     add_routes(app, 'handlers')        #When being requested the root folder by GET method, call index()
-    add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '0.0.0.0', 8080)
-    logging.info('Server started at http://127.0.0.1:8080...')
-    return srv
+    add_static(app, static)
+    handler = app.make_handler(access_log=None)        #logger_factory writes the access log
+    if sock is None:
+        srv = yield from loop.create_server(handler, configs.server.host, configs.server.port)
+    else:
+        srv = yield from loop.create_server(handler, sock=sock)
+    logging.info('Server %s started at http://127.0.0.1:%s...' % (os.getpid(), configs.server.port))
+    return app, handler, srv
 
-def application():
+@asyncio.coroutine
+def shutdown(app, handler, srv):
+    """
+    Stop accepting connections, let running requests finish, then close the connection pool.
+    """
+    srv.close()
+    yield from srv.wait_closed()
+    if hasattr(handler, 'shutdown'):
+        yield from handler.shutdown(configs.server.shutdown_timeout)        #aiohttp >= 2.0
+    else:
+        yield from handler.finish_connections(configs.server.shutdown_timeout)
+    app['__search_reload__'].cancel()
+    if configs.server.workers == 1:
+        app['__search__'].save()        #Workers would overwrite each other's writes, they rely on rebuilds
+    app['__search__'].close()
+    yield from app.finish()
+    executor.shutdown()
+    yield from orm.close_pool()
+    logging.info('Server %s stopped.' % os.getpid())
+
+def application(sock=None):
+    logs.setup(**configs.logging)        #In the worker, the writer thread does not survive fork
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(init(loop))
-    loop.run_forever()
+    app, handler, srv = loop.run_until_complete(init(loop, sock))
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)        #Graceful stop
+    loop.add_signal_handler(signal.SIGUSR1, app['__profiler__'].toggle)
+    try:
+        loop.run_forever()
+    finally:
+        try:
+            loop.run_until_complete(shutdown(app, handler, srv))
+            loop.close()
+        finally:
+            logs.stop()        #Writes the queued records even when the shutdown failed
+
+def main():
+    """
+    Run a single server, or a supervisor with prefork workers when configs.server.workers > 1.
+    """
+    server = configs.server
+    if server.workers > 1:
+        Supervisor(application, server.workers, server.host, server.port, server.reuse_port).run()
+    else:
+        application()
 
 if __name__ == '__main__':
-    application()
\ No newline at end of file
+    main()
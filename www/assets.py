@@ -0,0 +1,159 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+assets.py
+Static asset pipeline. build() copies the files of static/ to static/dist/ under names carrying
+their content hash, gzips them alongside and writes a manifest. Templates resolve asset URLs
+through the manifest, and fingerprinted files are served precompressed and cached forever.
+
+    python assets.py    #Build at deploy time, or set configs.assets.build to build at startup
+'''
+
+import os, json, gzip, hashlib, logging, mimetypes, asyncio
+
+from aiohttp import web
+
+from cache import LRUCache
+from responses import accepted_encodings
+from executor import run_in_thread
+
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+#Extensions worth a .gz sibling, images and fonts are compressed already
+_COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.map', '.xml')
+
+#Types not left to mimetypes, which reads them from the mime.types files of the system
+_TYPES = {
+    '.css': 'text/css',
+    '.js': 'application/javascript',
+    '.json': 'application/json',
+    '.map': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2'
+}
+
+def _write(path, data):
+    '''
+    Write atomically, workers building at the same time never read half a file.
+    '''
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def build(static_path=STATIC_PATH, level=9):
+    '''
+    Fingerprint every file of static_path, e.g. css/aresou.css => dist/css/aresou.1a2b3c4d5e.css,
+    and write the manifest of original => fingerprinted paths. Returns the manifest.
+    '''
+    dist = os.path.join(static_path, DIST)
+    manifest = dict()
+    for root, dirs, files in os.walk(static_path):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]        #Skip the output
+        for name in files:
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, static_path).replace(os.sep, '/')
+            with open(src, 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(rel)
+            hashed = '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:10], ext)
+            target = os.path.join(dist, hashed)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                _write(target, data)
+                if ext.lower() in _COMPRESSIBLE:
+                    _write(target + '.gz', gzip.compress(data, level))
+            manifest[rel] = '%s/%s' % (DIST, hashed)
+    os.makedirs(dist, exist_ok=True)
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    logging.info('Built %s static assets to %s' % (len(manifest), dist))
+    return manifest
+
+def content_type(name):
+    '''
+    (Content-Type, Content-Encoding or None) of a static file, a .gz file is typed by its original extension.
+    '''
+    encoding = None
+    if name.endswith('.gz'):
+        name, encoding = name[:-3], 'gzip'
+    ext = os.path.splitext(name)[1].lower()
+    return _TYPES.get(ext) or mimetypes.guess_type(name)[0] or 'application/octet-stream', encoding
+
+def load_manifest(static_path=STATIC_PATH):
+    try:
+        with open(os.path.join(static_path, DIST, MANIFEST), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except FileNotFoundError:
+        return dict()
+
+class Assets(object):
+    '''
+    URLs and serving of the static files. Fingerprinted files are read once, kept in memory
+    and sent with Cache-Control: immutable; the others (and the manifest, rewritten by every build)
+    are read from disk in the thread pool on every request.
+    '''
+    def __init__(self, static_path=STATIC_PATH, prefix='/static/'):
+        self.path = os.path.abspath(static_path)
+        self.prefix = prefix
+        self.manifest = load_manifest(static_path)
+        self._files = LRUCache(maxsize=256)        #name => (body, gzipped body or None)
+
+    def url(self, name):
+        '''
+        URL of a static file, fingerprinted when it is in the manifest. Used as static_url() in templates.
+        '''
+        return self.prefix + self.manifest.get(name, name)
+
+    def _read(self, full):
+        '''
+        (body, gzipped body or None) of a file, None if there is none.
+        '''
+        if not os.path.isfile(full):
+            return None
+        with open(full, 'rb') as f:
+            data = f.read()
+        gz = None
+        if os.path.isfile(full + '.gz'):
+            with open(full + '.gz', 'rb') as f:
+                gz = f.read()
+        return data, gz
+
+    @asyncio.coroutine
+    def handle(self, request):
+        name = request.match_info['path']
+        full = os.path.normpath(os.path.join(self.path, name))
+        if not full.startswith(self.path + os.sep):
+            raise web.HTTPNotFound()
+        immutable = name.startswith(DIST + '/') and name != DIST + '/' + MANIFEST
+        files = self._files.get(name) if immutable else None
+        if files is None:
+            files = yield from run_in_thread(self._read, full)
+            if files is None:
+                raise web.HTTPNotFound()
+            if immutable:
+                self._files.set(name, files)
+        body, gz = files
+        ctype, encoding = content_type(name)
+        headers = dict()
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding        #A .gz file asked for by its name
+        if immutable:
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'public, max-age=300'
+        if gz is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in accepted_encodings(request.headers.get('Accept-Encoding', '')):
+                body = gz
+                headers['Content-Encoding'] = 'gzip'
+        resp = web.Response(body=body, headers=headers)
+        resp.content_type = ctype
+        return resp
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build()
@@ -0,0 +1,177 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+cache.py
+In-process caches with TTL and LRU eviction, plus an optional shared backend.
+'''
+
+import time, asyncio, hashlib
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    Bounded mapping evicting the least recently used entry once maxsize is reached.
+    Entries older than ttl seconds are treated as missing, ttl=None keeps them until evicted.
+    '''
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()        #key => (value, expires)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)        #Mark as the most recently used
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)        #Drop the least recently used
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return self._data.keys()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+class CacheBackend(object):
+    '''
+    Interface of a cache shared between processes (memcached, redis...).
+    All the methods are coroutines so network clients can be plugged in.
+    '''
+    @asyncio.coroutine
+    def get(self, key):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def delete(self, key):
+        raise NotImplementedError
+
+class LocalBackend(CacheBackend):
+    '''
+    Stand-in backend keeping entries in process memory, used for tests and single-process setups.
+    '''
+    def __init__(self, maxsize=100000):
+        self._cache = LRUCache(maxsize)
+
+    @asyncio.coroutine
+    def get(self, key):
+        return self._cache.get(key)
+
+    @asyncio.coroutine
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl)
+
+    @asyncio.coroutine
+    def delete(self, key):
+        self._cache.delete(key)
+
+class SessionCache(object):
+    '''
+    Cache of user rows for validating session cookies, keyed by user id.
+    The local LRU is looked up first, then the shared backend if one is set.
+    '''
+    def __init__(self, maxsize=10000, ttl=300, backend=None):
+        self.ttl = ttl
+        self.backend = backend
+        self._local = LRUCache(maxsize, ttl)
+
+    def _key(self, uid):
+        return 'session:%s' % uid
+
+    @asyncio.coroutine
+    def get(self, uid):
+        row = self._local.get(uid)
+        if row is None and self.backend is not None:
+            row = yield from self.backend.get(self._key(uid))
+            if row is not None:
+                self._local.set(uid, row)
+        return row
+
+    @asyncio.coroutine
+    def set(self, uid, row):
+        self._local.set(uid, row)
+        if self.backend is not None:
+            yield from self.backend.set(self._key(uid), row, self.ttl)
+
+    @asyncio.coroutine
+    def invalidate(self, uid):
+        '''
+        Drop the cached row, must be called when the password or profile of a user changes.
+        '''
+        self._local.delete(uid)
+        if self.backend is not None:
+            yield from self.backend.delete(self._key(uid))
+
+class Page(object):
+    '''
+    A rendered response body kept by PageCache.
+    '''
+    __slots__ = ('body', 'content_type', 'etag', 'last_modified', 'tags', 'variants')
+
+    def __init__(self, body, content_type, tags=()):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.last_modified = time.time()
+        self.tags = tuple(tags)
+        self.variants = dict()        #Compressed bodies by content encoding
+
+class PageCache(object):
+    '''
+    Rendered pages with TTL and LRU eviction. Each page carries tags (table names)
+    and invalidate(tag) drops every page rendered from that table.
+    '''
+    def __init__(self, maxsize=256, ttl=60):
+        self._pages = LRUCache(maxsize, ttl)
+        self._tags = dict()        #tag => set of keys
+
+    def get(self, key):
+        return self._pages.get(key)
+
+    def set(self, key, body, content_type, tags=()):
+        page = Page(body, content_type, tags)
+        self._pages.set(key, page)
+        for tag in page.tags:
+            keys = self._tags.setdefault(tag, set())
+            keys.add(key)
+            if len(keys) > self._pages.maxsize:
+                keys.intersection_update(self._pages.keys())        #Forget the evicted pages
+        return page
+
+    def invalidate(self, tag):
+        for key in self._tags.pop(tag, ()):
+            self._pages.delete(key)
+
+    def clear(self):
+        self._pages.clear()
+        self._tags.clear()
@@ -7,14 +7,83 @@ Using dict to store settings.
 '''
 
 configs = {
+    'logging': {
+        'level': 'INFO',
+        'queue_size': 10000,    #Records waiting for the writer thread, more are dropped
+        'access_log': None,    #File of the JSON access log, e.g. '../log/access_log'; None writes it to stderr
+        'sql_sample': 0.01,    #Fraction of SQL statements logged
+        'debug_sample': 0.01    #Fraction of debug records logged when the level is DEBUG
+    },
+    'server': {
+        'host': '0.0.0.0',
+        'port': 8080,
+        'workers': 1,    #More than 1 runs prefork workers under a supervisor
+        'reuse_port': False,    #Workers bind their own SO_REUSEPORT socket instead of sharing one
+        'shutdown_timeout': 30    #Seconds given to running requests on stop or restart
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'kagami',
-        'db': 'aresou'
+        'db': 'aresou',
+        'replicas': [],    #Read replicas, e.g. {'host': '10.0.0.2', 'weight': 2}; other settings come from the primary
+        'health_interval': 5,    #Seconds between replica health checks
+        'maxsize': 10,
+        'minsize': 1,
+        'slow_query': 1.0,    #Seconds, slower queries are logged
+        'adaptive': False,    #Limit the connections of a pool from the observed acquire wait, between minsize and adaptive_max
+        'adaptive_max': 50,
+        'adaptive_wait': 0.005    #Mean acquire wait (seconds) above which the pool grows
     },
     'session': {
-        'secret': 'AresOu'
+        'secret': 'AresOu',
+        'cache': {
+            'maxsize': 10000,    #Users kept in the in-process session cache
+            'ttl': 300    #Seconds before a cached user is loaded again
+        }
+    },
+    'templating': {
+        'auto_reload': True,    #Check templates for changes on every render, turn off in production
+        'bytecode_cache': None,    #Directory keeping compiled templates between restarts, e.g. '/var/cache/aresou/jinja2'
+        'precompile': False,    #Compile every template at startup
+        'stream_chunk': 8192    #Characters rendered between two writes of a '__stream__' page
+    },
+    'assets': {
+        'build': False    #Fingerprint static files at startup, otherwise run `python assets.py` on deploy
+    },
+    'pagecache': {
+        'maxsize': 256,    #Rendered pages kept in memory
+        'ttl': 60
+    },
+    'compress': {
+        'min_size': 1024,    #Bodies smaller than this are sent uncompressed
+        'level': 6
+    },
+    'json': {
+        'stream_items': 1000,    #Results with more list items than this are streamed
+        'chunk': 256    #List items encoded per chunk when streaming
+    },
+    'executor': {
+        'threads': 4,    #Threads for blocking calls
+        'processes': 2,    #Processes for CPU-bound work (password hashing), per worker
+        'max_pending': 64,    #Jobs a pool takes at once, more wait for a slot
+        'wait': 1.0    #Seconds a job waits for a slot before the request fails with server:busy
+    },
+    'kdf': {
+        'iterations': 100000    #PBKDF2 rounds of stored passwords
+    },
+    'profiling': {
+        'rate': 0.0,    #Fraction of the requests profiled with cProfile
+        'toggle_rate': 0.01,    #Rate set by SIGUSR1 when profiling is off, SIGUSR1 again turns it off
+        'directory': None,    #Write .prof files there, None logs the top functions
+        'top': 30
+    },
+    'metrics': {
+        'public': False    #Serve /metrics to anyone (e.g. behind a private network), otherwise to admins only
+    },
+    'search': {
+        'path': None,    #File of the search index, None keeps it in ../data/search.idx
+        'reload_interval': 60    #Seconds between checks for an index rebuilt by `python search.py`
     }
 }
\ No newline at end of file
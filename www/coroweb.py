@@ -5,8 +5,11 @@ __author__ = 'aresowj'
 
 '''
 
-import functools, asyncio, inspect, os, logging
+import functools, asyncio, inspect, logging
+from urllib import parse
 from aiohttp import web
+from apis import APIError
+from assets import Assets
 
 def get(path):
     """
@@ -80,79 +83,103 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
-class RequestHandler(object):
-    def __init__(self, app, fn):
-        self._app = app
-        self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
-        
+@asyncio.coroutine
+def _body_params(request):
+    """
+    Arguments of a POST body, JSON or form encoded.
+    """
+    if not request.content_type:
+        raise web.HTTPBadRequest(text='Missing Content-Type.')
+    ct = request.content_type.lower()
+    if ct.startswith('application/json'):
+        params = yield from request.json()
+        if not isinstance(params, dict):
+            raise web.HTTPBadRequest(text='JSON body must be object.')
+        return params
+    if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        params = yield from request.post()
+        return dict(params)
+    raise web.HTTPBadRequest(text='Unspported Content-Type: %s' % request.content_type)
+
+@asyncio.coroutine
+def _query_params(request):
+    """
+    Arguments of a GET query string, None if there is none.
+    """
+    qs = request.query_string
+    if not qs:
+        return None
+    return dict((k, v[0]) for k, v in parse.parse_qs(qs, True).items())
+
+def compile_binder(fn):
+    """
+    Decide once, from the signature of fn, how a request is turned into its arguments.
+    Returns a coroutine function request => kw, raising HTTPBadRequest on invalid input.
+    """
+    has_request = has_request_arg(fn)
+    var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    required = get_required_kw_args(fn)
+    #Only functions taking keyword args read the body or the query string
+    extractors = dict(POST=_body_params, GET=_query_params) if var_kw or named else dict()
+    keep = named if named and not var_kw else None        #Drop params the function cannot take
+
     @asyncio.coroutine
-    def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = yield from request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = yield from request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unspported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
+    def bind(request):
+        extract = extractors.get(request.method)
+        params = (yield from extract(request)) if extract is not None else None
+        if params is None:
+            kw = dict(request.match_info)
         else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                #Remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                    kw = copy
-                #Check named args:
+            if keep is not None:
+                kw = dict((name, params[name]) for name in keep if name in params)
+            else:
+                kw = params
             for k, v in request.match_info.items():
                 if k in kw:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kw[k] = v
-        if self._has_request_arg:
+        if has_request:
             kw['request'] = request
-        #Check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('Call with args: %s' % str(kw))
+        for name in required:
+            if not name in kw:
+                raise web.HTTPBadRequest(text='Missing argument: %s' % name)
+        return kw
+    return bind
+
+class RequestHandler(object):
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self._bind = compile_binder(fn)        #Binding plan of the route, built once
+        
+    @asyncio.coroutine
+    def __call__(self, request):
+        try:
+            kw = yield from self._bind(request)
+        except web.HTTPBadRequest as e:
+            return e
+        logging.debug('Call with args: %s', kw)        #Formatted only if the record is kept
         try:
             r = yield from self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
-def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logging.info('Static %s added to %s' % ('/static/', path))
+def add_static(app, assets=None):
+    '''
+    Serve static/ through an assets.Assets, which sends fingerprinted files precompressed and cached.
+    '''
+    if assets is None:
+        assets = Assets()
+    app.router.add_route('GET', assets.prefix + '{path:.*}', assets.handle)
+    logging.info('Static %s added to %s' % (assets.prefix, assets.path))
 
 def add_route(app, fn):
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
-        raise ValueError('@get or @post not defined in %s.' % str(fb))
+        raise ValueError('@get or @post not defined in %s.' % str(fn))
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
     
@@ -0,0 +1,154 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+executor.py
+Thread and process pools for blocking or CPU-bound work (password hashing, rendering), so it
+never runs on the event loop. Each pool takes at most max_pending jobs at once: callers beyond
+that wait up to `wait` seconds for a slot, then get APIBusyError instead of queueing without bound.
+'''
+
+import time, asyncio, logging, functools, importlib, collections, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import metrics
+from apis import APIBusyError
+
+JOB_TIME = metrics.Histogram('executor_job_seconds', 'Time of an offloaded job, from submission to result.', ('pool',))
+PENDING = metrics.Gauge('executor_pending', 'Offloaded jobs submitted and not finished.', ('pool',),
+    fn=lambda: [((name,), pool.pending) for name, pool in _pools.items()])
+REJECTED = metrics.Counter('executor_rejected_total', 'Jobs refused because the pool stayed saturated.', ('pool',))
+
+class Pool(object):
+    '''
+    Executor admitting at most max_pending jobs. It is created on first use, so prefork
+    workers each start their own processes after the fork.
+    '''
+    def __init__(self, name, factory, workers, max_pending, wait):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait = wait
+        self.pending = 0
+        self._factory = factory
+        self._executor = None
+        self._waiters = collections.deque()
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = self._factory(self.workers)
+            logging.info('Executor %s started with %s workers' % (self.name, self.workers))
+        return self._executor
+
+    @asyncio.coroutine
+    def _acquire(self):
+        deadline = time.monotonic() + self.wait
+        while self.pending >= self.max_pending:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                REJECTED.inc(1, self.name)
+                raise APIBusyError('Server busy, please retry later.')
+            fut = asyncio.Future()
+            self._waiters.append(fut)
+            try:
+                yield from asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.pending += 1
+
+    def _release(self):
+        self.pending -= 1
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+    @asyncio.coroutine
+    def run(self, fn, *args, **kw):
+        '''
+        Run fn(*args, **kw) in the pool and return its result.
+        '''
+        yield from self._acquire()
+        start = time.monotonic()
+        try:
+            if kw:
+                fn = functools.partial(fn, **kw)
+            return (yield from asyncio.get_event_loop().run_in_executor(self.executor(), fn, *args))
+        finally:
+            self._release()
+            JOB_TIME.observe(time.monotonic() - start, self.name)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+#Pool processes start from a forkserver: forking the app itself would copy it with the locks held by
+#its threads (the log writer, the thread pool) at that moment, and the children could deadlock on them
+_process_executor = functools.partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('forkserver'))
+
+_pools = dict(
+    thread=Pool('thread', ThreadPoolExecutor, 4, 64, 1.0),
+    process=Pool('process', _process_executor, 2, 64, 1.0)
+)
+
+def setup(threads=4, processes=2, max_pending=64, wait=1.0):
+    '''
+    Size the pools, see configs.executor. Must be called before their first use.
+    '''
+    shutdown()
+    _pools['thread'] = Pool('thread', ThreadPoolExecutor, threads, max_pending, wait)
+    _pools['process'] = Pool('process', _process_executor, processes, max_pending, wait)
+
+def shutdown():
+    for pool in _pools.values():
+        pool.shutdown()
+
+@asyncio.coroutine
+def run_in_thread(fn, *args, **kw):
+    '''
+    Run a blocking function (file or network IO, C code releasing the GIL) in the thread pool.
+    '''
+    return (yield from _pools['thread'].run(fn, *args, **kw))
+
+@asyncio.coroutine
+def run_in_process(fn, *args, **kw):
+    '''
+    Run a CPU-bound function in the process pool. fn and its arguments must be picklable.
+    '''
+    return (yield from _pools['process'].run(fn, *args, **kw))
+
+_offloaded = dict()        #(module, name) => function wrapped by offload(), looked up in the pool processes
+
+def _call(module, name, args, kw):
+    importlib.import_module(module)        #Registers the function when the process did not fork from the app
+    return _offloaded[(module, name)](*args, **kw)
+
+def offload(kind='thread'):
+    '''
+    Define decorator @offload('thread') or @offload('process'), turning a plain function into
+    a coroutine that runs it in that pool:
+
+        @offload('process')
+        def hash_password(password):
+            ...
+
+        hashed = yield from hash_password(password)
+
+    Functions sent to processes are found again by module and name, so define them at module level.
+    The blocking function stays available as .sync, e.g. for scripts.
+    '''
+    def decorator(func):
+        key = (func.__module__, func.__qualname__)
+        _offloaded[key] = func
+
+        @functools.wraps(func)
+        @asyncio.coroutine
+        def wrapper(*args, **kw):
+            if kind == 'process':
+                return (yield from _pools[kind].run(_call, key[0], key[1], args, kw))
+            return (yield from _pools[kind].run(func, *args, **kw))
+        wrapper.sync = func
+        return wrapper
+    return decorator
@@ -5,9 +5,35 @@ __author__ = 'aresowj'
 URL handlers, to be filled.
 '''
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, asyncio, collections
+from aiohttp import web
+import orm
+import serializer
+import metrics
 from coroweb import get, post
+from apis import APIError, APIValueError
 from models import User, Comment, Blog, next_id
+from config import configs
+from cache import SessionCache
+from passwords import hash_password
+
+COOKIE_NAME = 'aresou_session'
+_COOKIE_KEY = configs.session.secret
+
+#Users validated by cookie2user, so an authenticated request does not hit MySQL on every call.
+_SESSION_CACHE = SessionCache(**configs.session.cache)
+
+def invalidate_session(uid):
+    '''
+    Forget the cached user, to be waited for after the password or profile changed.
+    '''
+    return _SESSION_CACHE.invalidate(uid)
+
+def _on_model_change(action, model):
+    if isinstance(model, User):
+        return invalidate_session(model.getValue(User.__primary_key__))
+
+orm.add_listener(_on_model_change)
 
 def user2cookie(user, max_age):
     '''
@@ -15,7 +41,7 @@ def user2cookie(user, max_age):
     '''
     # build cookie string by: id-expires-sha1
     expires = str(int(time.time() + max_age))
-    s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
+    s = '%s-%s-%s-%s' % (user.id, user.password, expires, _COOKIE_KEY)
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
@@ -33,14 +59,19 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = yield from User.find(uid)
-        if user is None:
-            return None
-        s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
+        row = yield from _SESSION_CACHE.get(uid)
+        if row is None:
+            user = yield from User.find(uid)
+            if user is None:
+                return None
+            row = dict(user)
+            yield from _SESSION_CACHE.set(uid, row)
+        s = '%s-%s-%s-%s' % (uid, row['password'], expires, _COOKIE_KEY)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.passwd = '******'
+        user = User(**row)    #A fresh copy, the cached row keeps the real password
+        user.password = '******'
         return user
     except Exception as e:
         logging.exception(e)
@@ -56,21 +87,77 @@ def index(request):
     ]
     return {
         '__template__': 'blogs.html',
+        '__cache__': ('blogs',),
         'blogs': blogs,
     }
     
+@get('/blog/{id}')
+def get_blog(id):
+    '''
+    A blog and its comments, their HTML is the one stored when they were written (see rendering.py).
+    '''
+    blog = yield from Blog.find(id)
+    if blog is None:
+        raise web.HTTPNotFound()
+    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_time desc', records=True)
+    authors = yield from load_authors([blog] + comments)
+    return {
+        '__template__': 'blog.html',
+        '__cache__': ('blogs', 'comments', 'users'),
+        'blog': blog,
+        'comments': comments,
+        'authors': authors,
+    }
+
+@asyncio.coroutine
+def load_authors(rows):
+    '''
+    Users who wrote rows (blogs or comments) by id, looked up together through the Loader
+    of the request: one query for all of them instead of one per row.
+    '''
+    uids = list(collections.OrderedDict.fromkeys(r.user_id for r in rows))
+    users = yield from User.loadMany(uids)
+    return dict((u.id, u) for u in users if u is not None)
+
+def get_page_size(limit, default=20, maximum=100):
+    try:
+        n = int(limit)
+    except (TypeError, ValueError):
+        return default
+    return min(max(n, 1), maximum)
+
 @get('/api/users')
-def api_get_users(*, page='1'):
-    '''page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())'''
-    users = yield from User.findAll(orderBy='created_time desc')    #, limit=(p.offset, p.limit)
-    for u in users:
-        u.password = '******'
-
-    return dict(users=users)    #page=p,
+def api_get_users(*, cursor=None, limit='20'):
+    '''
+    List users newest first. Pass the returned `next` as cursor to get the following page.
+    '''
+    try:
+        users, next_cursor = yield from User.findPage(cursor=cursor, limit=get_page_size(limit))
+    except ValueError:
+        raise APIValueError('cursor')
+    return dict(users=users, next=next_cursor)    #Passwords are left out by User.__json_exclude__
+
+@get('/api/blogs')
+def api_get_blogs(*, cursor=None, limit='20'):
+    try:
+        blogs, next_cursor = yield from Blog.findPage(cursor=cursor, limit=get_page_size(limit), records=True)
+    except ValueError:
+        raise APIValueError('cursor')
+    authors = yield from load_authors(blogs)
+    return dict(blogs=blogs, authors=authors, next=next_cursor)    #Passwords are left out by User.__json_exclude__
+
+@get('/api/search')
+def api_search(request, *, q, limit='20'):
+    '''
+    Blogs and comments matching q, best first, from the in-process search index.
+    '''
+    if not q or not q.strip():
+        raise APIValueError('q', 'Search query cannot be empty.')
+    results = []
+    for key, title, score in request.app['__search__'].search(q, get_page_size(limit)):
+        table, pk = key.split(':', 1)
+        results.append(dict(type=table, id=pk, title=title, score=round(score, 4)))
+    return dict(results=results)
 
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
@@ -87,15 +174,14 @@ def api_register_user(*, email, name, password):
     if len(users) > 0:
         raise APIError('Register failed, the email address is already in use.')
     uid = next_id()
-    sha1_password = '%s:%s' % (uid, password)
-    user = User(id=uid, name=name.strip(), email=email, password=hashlib.sha1(sha1_password.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
+    hashed = yield from hash_password(password, configs.kdf.iterations)        #In the process pool, the loop keeps serving
+    user = User(id=uid, name=name.strip(), email=email, password=hashed, image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
     yield from user.save()
     #Make session cookie
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 @get('/register')
@@ -103,3 +189,17 @@ def register_user(request):
     return {
         '__template__' : 'register.html',
     }
+
+@get('/metrics')
+def metrics_text(request):
+    '''
+    Metrics (request latencies by route, connection pools, queries...) in the Prometheus text format.
+    Admins only unless configs.metrics.public, the query shapes tell about the schema.
+    '''
+    if not configs.metrics.public:
+        user = yield from cookie2user(request.cookies.get(COOKIE_NAME))
+        if user is None or not user.admin:
+            raise web.HTTPForbidden()
+    r = web.Response(body=metrics.render().encode('utf-8'))
+    r.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return r
@@ -0,0 +1,107 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+logs.py
+Non-blocking logging. Records are put on a bounded queue and written by a background thread,
+when the queue is full they are dropped rather than blocking the event loop.
+Chatty records (SQL, debug) are sampled, and the access log is written as JSON lines.
+'''
+
+import logging, logging.handlers, queue, random, json, time
+import metrics
+
+DROPPED = metrics.Counter('log_records_dropped_total', 'Log records dropped because the queue was full.')
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler on a bounded queue, counting the records it drops when the queue is full.
+    '''
+    def __init__(self, q):
+        super(DroppingQueueHandler, self).__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record        #Formatting is left to the writer thread
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc()
+
+class SamplingFilter(logging.Filter):
+    '''
+    Let through a fraction rate of the records below level, all the others.
+    '''
+    def __init__(self, rate, level=logging.WARNING):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or random.random() < self.rate
+
+class _ExcludeFilter(logging.Filter):
+    def filter(self, record):
+        return not super(_ExcludeFilter, self).filter(record)
+
+class AccessFormatter(logging.Formatter):
+    '''
+    One JSON object per request, from the fields passed as extra=dict(access=...).
+    '''
+    def format(self, record):
+        fields = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)))
+        fields.update(getattr(record, 'access', {}))
+        return json.dumps(fields, ensure_ascii=False)
+
+access_logger = logging.getLogger('access')
+sql_logger = logging.getLogger('sql')
+
+_handlers = None        #Handlers of the root logger before the first setup
+_listener = None        #Of the last setup, stopped by the next one
+
+def setup(level='INFO', queue_size=10000, access_log=None, sql_sample=0.01, debug_sample=0.01):
+    '''
+    Move the handlers of the root logger behind a queue and start the writer thread.
+    access_log is the file of the access log, None writes it to stderr; either way as JSON lines.
+    Call stop() on exit so the queue is flushed. Calling setup again (tests, workers) stops the
+    previous writer thread and replaces its queue and access log. Returns the QueueListener.
+    '''
+    global _handlers, _listener
+    root = logging.getLogger()
+    if _handlers is None:
+        _handlers = root.handlers[:] or [logging.StreamHandler()]
+        for h in _handlers:
+            h.addFilter(_ExcludeFilter('access'))        #Their formatters would drop the fields of the record
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    stop()
+    handlers = _handlers[:]
+    access = logging.FileHandler(access_log) if access_log is not None else logging.StreamHandler()
+    access.addFilter(logging.Filter('access'))
+    access.setFormatter(AccessFormatter())
+    handlers.append(access)
+    q = queue.Queue(queue_size)
+    qh = DroppingQueueHandler(q)
+    qh.addFilter(SamplingFilter(debug_sample, logging.INFO))        #Debug records are sampled
+    root.addHandler(qh)
+    root.setLevel(level)
+    for f in sql_logger.filters[:]:
+        if isinstance(f, SamplingFilter):
+            sql_logger.removeFilter(f)        #Setup again (tests, workers) replaces the rate instead of multiplying it
+    sql_logger.addFilter(SamplingFilter(sql_sample))
+    listener = _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def stop():
+    '''
+    Stop the writer thread of the last setup once it has written the queued records.
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener.handlers[-1].close()        #The access log
+        _listener = None
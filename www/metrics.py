@@ -0,0 +1,181 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+metrics.py
+In-process counters, gauges and histograms, rendered in the Prometheus text format.
+Observations can also be forwarded to sinks (statsd, logs...) registered by add_sink.
+Spans add up the time the current request spends in a kind of work (db, render...).
+'''
+
+import time, bisect, contextvars
+
+#Seconds, suited to query, pool and request latencies
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []        #In registration order
+_sinks = []
+_spans = contextvars.ContextVar('metrics_spans', default=None)        #kind => seconds, of the current request
+
+def add_sink(fn):
+    '''
+    Register fn(name, labels, value), called on every counter increment and histogram observation.
+    '''
+    _sinks.append(fn)
+
+def _emit(name, labels, value):
+    for fn in _sinks:
+        fn(name, labels, value)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=(), max_series=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series        #Label sets kept apart, the ones seen later are added up under 'other'
+        _metrics.append(self)
+
+    def _key(self, labels, series):
+        if self.max_series is None or labels in series or len(series) < self.max_series:
+            return labels
+        return ('other',) * len(labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), max_series=None):
+        super(Counter, self).__init__(name, help, labels, max_series)
+        self._values = dict()        #label values => count
+
+    def inc(self, value=1, *labels):
+        labels = self._key(labels, self._values)
+        self._values[labels] = self._values.get(labels, 0) + value
+        if _sinks:
+            _emit(self.name, labels, value)
+
+    def samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, k), v) for k, v in self._values.items()]
+
+class Gauge(Metric):
+    '''
+    Gauge set directly, or computed at render time by fn returning [(label values, value)].
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self._values = dict()
+        self._fn = fn
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, value=1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def dec(self, value=1, *labels):
+        self.inc(-value, *labels)
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        values = self._fn() if self._fn is not None else self._values.items()
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, k), v) for k, v in values]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, max_series=None):
+        super(Histogram, self).__init__(name, help, labels, max_series)
+        self.buckets = tuple(buckets)
+        self._series = dict()        #label values => [bucket counts..., count, sum]
+
+    def observe(self, value, *labels):
+        labels = self._key(labels, self._series)
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1        #Counts are made cumulative on render
+        series[-1] += value
+        if _sinks:
+            _emit(self.name, labels, value)
+
+    def stats(self, *labels):
+        '''
+        (count, sum) observed for the label values.
+        '''
+        series = self._series.get(labels)
+        if series is None:
+            return 0, 0.0
+        return sum(series[:-1]), series[-1]
+
+    def samples(self):
+        lines = []
+        for labels, series in self._series.items():
+            total = 0
+            for bound, n in zip(self.buckets, series):
+                total += n
+                lines.append('%s_bucket%s %s' % (self.name, _format_labels(self.labels, labels, ('le', bound)), total))
+            total += series[len(self.buckets)]
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(self.labels, labels, ('le', '+Inf')), total))
+            lines.append('%s_count%s %s' % (self.name, _format_labels(self.labels, labels), total))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, labels), series[-1]))
+        return lines
+
+def render():
+    '''
+    All the metrics in the Prometheus text exposition format.
+    '''
+    lines = []
+    for m in _metrics:
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
+
+def start_spans():
+    '''
+    Start adding up span times in the current context. Returns (spans dict, token for reset_spans).
+    '''
+    spans = dict()
+    return spans, _spans.set(spans)
+
+def reset_spans(token):
+    _spans.reset(token)
+
+def add_span(kind, seconds):
+    spans = _spans.get()
+    if spans is not None:
+        spans[kind] = spans.get(kind, 0.0) + seconds
+
+class span(object):
+    '''
+    Context manager adding the time of its block to the spans of the current request:
+        with metrics.span('render'):
+    '''
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        add_span(self.kind, time.monotonic() - self._start)
@@ -8,6 +8,7 @@ Set up basic models.
 
 import time, uuid
 from orm import Model, StringField, BooleanField, FloatField, TextField
+from rendering import prepare_content
 
 def next_id():
     #Generate random ID with time (15 digits) and uuid4 (random hex)
@@ -15,10 +16,11 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __json_exclude__ = ('password',)
     
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')    #Passing next_id for future initiation.
     email = StringField(ddl='varchar(50)')
-    password = StringField(ddl='varchar(50)')
+    password = StringField(ddl='varchar(128)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
@@ -26,6 +28,8 @@ class User(Model):
     
 class Blog(Model):
     __table__ = 'blogs'
+    __json_exclude__ = ('content_hash',)
+    __before_write__ = prepare_content    #Stores the rendered content_html, see rendering.py
     
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -33,16 +37,22 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     title = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    context = TextField()
+    content = TextField()
+    content_html = TextField()
+    content_hash = StringField(ddl='varchar(40)')    #sha1 of the content content_html was rendered from
     created_time = FloatField(default=time.time)
     
 class Comment(Model):
     __table__ = 'comments'
+    __json_exclude__ = ('content_hash',)
+    __before_write__ = prepare_content
     
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    context = TextField()
+    content = TextField()
+    content_html = TextField()
+    content_hash = StringField(ddl='varchar(40)')    #sha1 of the content content_html was rendered from
     created_time = FloatField(default=time.time)
\ No newline at end of file
@@ -7,12 +7,79 @@ Database connection module for MySQL.
 Using aoimysql to keep implementing async methods in all program layers.
 '''
 
-import logging
+import logging, collections, functools, json, base64, contextvars, time, re
 
 import asyncio, aiomysql
+import metrics
+from cache import LRUCache
+from logs import sql_logger
+
+@functools.lru_cache(maxsize=1024)
+def compile_sql(sql):
+    '''
+    Convert the '?' placeholders of sql to the '%s' of the driver, memoized by the raw SQL.
+    '''
+    return sql.replace('?', '%s')
+
+POOL_WAIT = metrics.Histogram('db_pool_acquire_seconds', 'Time spent waiting for a pooled connection.', ('pool',))
+POOL_CHECKOUT = metrics.Histogram('db_pool_checkout_seconds', 'Time a pooled connection was held.', ('pool',))
+POOL_IN_USE = metrics.Gauge('db_pool_in_use', 'Pooled connections checked out.', ('pool',))
+POOL_SIZE = metrics.Gauge('db_pool_size', 'Open connections of the pool.', ('pool',),
+    fn=lambda: [((name,), pool.size) for pool, name in _names.items()])
+POOL_LIMIT = metrics.Gauge('db_pool_limit', 'Connections the adaptive pool allows at once.', ('pool',),
+    fn=lambda: [((_names[pool],), limiter.limit) for pool, limiter in _limiters.items()])
+#Past MAX_SQL_SHAPES, the queries of a new shape are counted under sql="other"
+MAX_SQL_SHAPES = 200
+QUERY_TIME = metrics.Histogram('db_query_seconds', 'Query latency by SQL shape.', ('sql',), max_series=MAX_SQL_SHAPES)
+SLOW_QUERIES = metrics.Counter('db_slow_queries_total', 'Queries slower than configs.db.slow_query.', ('sql',), max_series=MAX_SQL_SHAPES)
+
+_slow_query = 1.0    #Seconds, set by create_pool
+
+#Consecutive row placeholders of a multi-row insert, and `in (?, ...)` lists, collapsed in the shape of a statement
+_RE_ROWS = re.compile(r'\([?, ]+\)(?:, \([?, ]+\))+')
+_RE_IN = re.compile(r'\bin \([?, ]+\)', re.IGNORECASE)
+#String and number literals written into a statement instead of passed as arguments
+_RE_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+
+@functools.lru_cache(maxsize=1024)
+def sql_shape(sql):
+    '''
+    Statement used as the metrics label of sql: multi-row inserts and in-lists of any size share one shape,
+    so batches do not create a label set per size, and literals are replaced by ?.
+    '''
+    return _RE_IN.sub('in (...)', _RE_ROWS.sub('(...)', _RE_LITERAL.sub('?', sql)))
 
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    sql_logger.info('SQL: %s', sql)        #Sampled, see logs.setup
+
+_listeners = []
+
+def add_listener(fn):
+    '''
+    Register fn(action, model) to be called after a model has been written.
+    fn may return a coroutine, which is waited for.
+    '''
+    _listeners.append(fn)
+
+@asyncio.coroutine
+def before_write(models):
+    '''
+    Run the __before_write__ hook of the models about to be saved or updated.
+    '''
+    for model in models:
+        if model.__before_write__ is not None:
+            yield from model.__before_write__()
+
+@asyncio.coroutine
+def notify(action, model):
+    model.__counts__.clear()        #Cached counts of the table are stale now
+    loader = _loader.get()
+    if loader is not None:
+        loader.forget(model_class(model), model.get(model_class(model).__primary_key__))
+    for fn in _listeners:
+        r = fn(action, model)
+        if asyncio.iscoroutine(r):
+            yield from r
 
 def create_args_string(length):
     L = []
@@ -21,15 +88,124 @@ def create_args_string(length):
         
     return ', '.join(L)
 
-#Create connection pool
+__pool = None    #Created by create_pool in every worker process, the primary server
+_replicas = []    #Read replicas, see create_pool
+_health_task = None
+
+#Set once the current request (task) has written, its reads then go to the primary to see the write
+_pinned = contextvars.ContextVar('orm_pinned', default=False)
+
+_names = dict()    #pool => name used in the metrics
+_limiters = dict()    #pool => _Limiter, when the pools are adaptive
+_adaptive_task = None
+
+class _Limiter(object):
+    '''
+    Semaphore whose limit can change while connections are checked out.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.peak = 0        #Highest active since the last resize check
+        self._waiters = collections.deque()
+
+    @asyncio.coroutine
+    def acquire(self):
+        while self.active >= self.limit:
+            fut = asyncio.Future()
+            self._waiters.append(fut)
+            yield from fut
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def resize(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.active
+        while self._waiters and free > 0:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                free -= 1
+
+class _Checkout(object):
+    '''
+    Context manager giving a connection back to its pool, recording how long it was held.
+    '''
+    def __init__(self, pool, conn, name, limiter):
+        self._pool = pool
+        self._conn = conn
+        self._name = name
+        self._limiter = limiter
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        POOL_CHECKOUT.observe(time.monotonic() - self._start, self._name)
+        POOL_IN_USE.dec(1, self._name)
+        self._pool.release(self._conn)
+        if self._limiter is not None:
+            self._limiter.release()
+
 @asyncio.coroutine
-def create_pool(loop, **kw):
+def _connection(pool):
     '''
-    Create a connection pool. loop: the main app loop; kw: a dict of arguments for the connection settings
+    Check out a connection of pool, use as: with (yield from _connection(pool)) as conn
     '''
-    logging.info('Creating database connection pool...')
-    global __pool    #The pool
-    __pool = yield from aiomysql.create_pool(
+    name = _names.get(pool, 'primary')
+    limiter = _limiters.get(pool)
+    start = time.monotonic()
+    if limiter is not None:
+        yield from limiter.acquire()
+    try:
+        conn = yield from pool.acquire()
+    except BaseException:
+        if limiter is not None:
+            limiter.release()
+        raise
+    waited = time.monotonic() - start
+    POOL_WAIT.observe(waited, name)
+    metrics.add_span('db', waited)
+    POOL_IN_USE.inc(1, name)
+    return _Checkout(pool, conn, name, limiter)
+
+@asyncio.coroutine
+def _run(cur, sql, args):
+    '''
+    Execute sql on cur, recording its latency by shape and logging it when slow.
+    '''
+    start = time.monotonic()
+    yield from cur.execute(compile_sql(sql), args)
+    elapsed = time.monotonic() - start
+    metrics.add_span('db', elapsed)
+    shape = sql_shape(sql)
+    QUERY_TIME.observe(elapsed, shape)
+    if elapsed >= _slow_query:
+        SLOW_QUERIES.inc(1, shape)
+        logging.warning('Slow query (%.3fs): %s' % (elapsed, sql))
+
+class Replica(object):
+    '''
+    A read replica pool, picked by smooth weighted round-robin while healthy.
+    '''
+    def __init__(self, name, pool, weight=1):
+        self.name = name
+        self.pool = pool
+        self.weight = weight
+        self.current = 0
+        self.healthy = True
+
+@asyncio.coroutine
+def _connect(loop, kw):
+    return (yield from aiomysql.create_pool(
         host = kw.get('host', 'localhost'),
         port = kw.get('port', 3306),
         user = kw['user'],    #Must be provided
@@ -40,25 +216,185 @@ def create_pool(loop, **kw):
         maxsize = kw.get('maxsize', 10),
         minsize = kw.get('minsize', 1),
         loop = loop
-    )
-    
+    ))
+
+#Create connection pool
 @asyncio.coroutine
-def select(sql, args, size=None):
+def create_pool(loop, **kw):
+    '''
+    Create a connection pool. loop: the main app loop; kw: a dict of arguments for the connection settings
+    kw['replicas'] is an optional list of read replicas: dicts overriding the settings of the primary
+    (host, port...) with an optional weight.
+    With kw['adaptive'], pools may grow up to adaptive_max connections but only allow as many at once
+    as the observed acquire wait calls for, starting from maxsize; the idle connections above the limit
+    are closed when it shrinks.
+    '''
+    logging.info('Creating database connection pool...')
+    global __pool, _health_task, _adaptive_task, _slow_query    #The pool
+    _slow_query = kw.get('slow_query', 1.0)
+    adaptive = kw.get('adaptive', False)
+    if adaptive:
+        kw = dict(kw, maxsize=kw.get('adaptive_max', 50))
+    __pool = yield from _connect(loop, kw)
+    _names[__pool] = 'primary'
+    for r in kw.get('replicas', ()):
+        settings = dict(kw)
+        settings.update(r)
+        name = '%s:%s' % (settings.get('host', 'localhost'), settings.get('port', 3306))
+        logging.info('Creating replica connection pool %s...' % name)
+        pool = yield from _connect(loop, settings)
+        _names[pool] = name
+        _replicas.append(Replica(name, pool, settings.get('weight', 1)))
+    if _replicas:
+        _health_task = loop.create_task(_check_replicas(kw.get('health_interval', 5)))
+    if adaptive:
+        for pool in _names:
+            _limiters[pool] = _Limiter(kw.get('maxsize', 10))
+        _adaptive_task = loop.create_task(_adapt_pools(kw.get('minsize', 1), kw['maxsize'],
+            kw.get('adaptive_wait', 0.005), kw.get('adaptive_interval', 5)))
+
+@asyncio.coroutine
+def _adapt_pools(minsize, maxsize, target_wait, interval):
+    '''
+    Every interval, grow the limit of a pool whose mean acquire wait is above target_wait,
+    shrink it by one when waits are negligible and less than half the limit was used.
+    A pool holding more connections than its new limit has its idle ones closed, it reopens
+    at most the limit since no more are checked out at once.
+    '''
+    last = dict()
+    while True:
+        yield from asyncio.sleep(interval)
+        for pool, limiter in _limiters.items():
+            name = _names[pool]
+            count, total = POOL_WAIT.stats(name)
+            prev_count, prev_total = last.get(name, (0, 0.0))
+            last[name] = (count, total)
+            n = count - prev_count
+            wait = (total - prev_total) / n if n else 0.0
+            limit = limiter.limit
+            if wait > target_wait and limit < maxsize:
+                limit = min(maxsize, limit + max(1, limit // 4))
+            elif wait < target_wait / 10 and limiter.peak < limit / 2 and limit > minsize:
+                limit -= 1
+            if limit != limiter.limit:
+                logging.info('Pool %s limit %s => %s (mean wait %.4fs)' % (name, limiter.limit, limit, wait))
+                limiter.resize(limit)
+                if pool.size > limit:
+                    yield from pool.clear()        #Closes the free connections only
+            limiter.peak = limiter.active
+
+@asyncio.coroutine
+def _check_replicas(interval):
+    '''
+    Ping every replica periodically, failed ones get no reads until they answer again.
+    '''
+    while True:
+        yield from asyncio.sleep(interval)
+        for replica in _replicas:
+            try:
+                with (yield from replica.pool) as conn:
+                    yield from conn.ping()
+                if not replica.healthy:
+                    logging.info('Replica %s is back.' % replica.name)
+                replica.healthy = True
+            except Exception as e:
+                if replica.healthy:
+                    logging.warning('Replica %s is down: %s' % (replica.name, e))
+                replica.healthy = False
+
+def _pick_replica():
+    '''
+    Smooth weighted round-robin over the healthy replicas, None if there is none.
+    '''
+    best = None
+    total = 0
+    for replica in _replicas:
+        if not replica.healthy:
+            continue
+        replica.current += replica.weight
+        total += replica.weight
+        if best is None or replica.current > best.current:
+            best = replica
+    if best is not None:
+        best.current -= total
+    return best
+
+def pin_primary():
+    '''
+    Send the following reads of the current request to the primary.
+    '''
+    _pinned.set(True)
+
+def unpin():
+    '''
+    Start a request unpinned: keep-alive requests share a task, pinning must not outlive the request.
+    Returns a token for reset_pin.
+    '''
+    return _pinned.set(False)
+
+def reset_pin(token):
+    _pinned.reset(token)
+
+def _read_replica(primary=None):
+    '''
+    Replica to read from, None for the primary. primary=True forces the primary,
+    primary=False allows a replica even after a write of the request.
+    '''
+    if primary or not _replicas or (primary is None and _pinned.get()):
+        return None
+    return _pick_replica()
+
+def _read_pool(primary=None):
+    replica = _read_replica(primary)
+    return __pool if replica is None else replica.pool
+
+@asyncio.coroutine
+def close_pool():
+    '''
+    Close the connection pools, waiting for the connections in use to be released.
+    '''
+    global __pool, _health_task, _adaptive_task
+    for task in (_health_task, _adaptive_task):
+        if task is not None:
+            task.cancel()
+    _health_task = _adaptive_task = None
+    _names.clear()
+    _limiters.clear()
+    pools = [r.pool for r in _replicas]
+    del _replicas[:]
+    if __pool is not None:
+        pools.append(__pool)
+        __pool = None
+    for pool in pools:
+        pool.close()
+        yield from pool.wait_closed()
+
+@asyncio.coroutine
+def select(sql, args, size=None, primary=None):
     '''
     Wrapped select method. Returns a list of tuples.
+    Reads from a replica when there are some, see _read_replica for primary.
     '''
     log(sql, args)
-    global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = yield from cur.fetchmany(size)        #Fetch a size of data if this parameter is passed
-        else:
-            rs = yield from cur.fetchall()
-        yield from cur.close()
-        logging.info('Rows returned: %s' % len(rs))
-        return rs
+    replica = _read_replica(primary)
+    pool = __pool if replica is None else replica.pool
+    try:
+        with (yield from _connection(pool)) as conn:
+            cur = yield from conn.cursor(aiomysql.DictCursor)
+            yield from _run(cur, sql, args or ())
+            if size:
+                rs = yield from cur.fetchmany(size)        #Fetch a size of data if this parameter is passed
+            else:
+                rs = yield from cur.fetchall()
+            yield from cur.close()
+    except aiomysql.OperationalError as e:
+        if replica is None:
+            raise
+        logging.warning('Replica %s failed, reading from primary: %s' % (replica.name, e))
+        replica.healthy = False
+        return (yield from select(sql, args, size, True))
+    sql_logger.info('Rows returned: %s', len(rs))
+    return rs
         
 @asyncio.coroutine
 def execute(sql, args):
@@ -66,16 +402,386 @@ def execute(sql, args):
     Wrapped function for insert, update and delete. Returns rows affected
     '''
     log(sql)
-    with (yield from __pool) as conn:
+    _pinned.set(True)
+    with (yield from _connection(__pool)) as conn:
         try:
             cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            yield from _run(cur, sql, args)
             affected = cur.rowcount
             yield from cur.close()
         except BaseException as e:
             raise
         return affected        #Return rows affected
 
+@asyncio.coroutine
+def execute_batches(batches):
+    '''
+    Run a list of (sql, args) on one connection, each statement in its own transaction.
+    Returns the rows affected by every statement.
+    '''
+    counts = []
+    _pinned.set(True)
+    with (yield from _connection(__pool)) as conn:
+        cur = yield from conn.cursor()
+        try:
+            for sql, args in batches:
+                log(sql)
+                yield from conn.begin()
+                try:
+                    yield from _run(cur, sql, args)
+                    yield from conn.commit()
+                except BaseException:
+                    yield from conn.rollback()
+                    raise
+                counts.append(cur.rowcount)
+        finally:
+            yield from cur.close()
+    return counts
+
+class RowIterator(object):
+    '''
+    Async iterator over the rows of a select, read batch by batch from a server-side cursor.
+    The connection is only taken from the first row until the rows run out or close() is called,
+    use it with `async with` or call close() when leaving the loop early.
+    '''
+    def __init__(self, sql, args, batch=500, factory=dict):
+        self._sql = sql
+        self._args = args or ()
+        self._batch = batch
+        self._factory = factory
+        self._checkout = None
+        self._cur = None
+        self._rows = collections.deque()
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._rows:
+            if self._closed:
+                raise StopAsyncIteration
+            if self._cur is None:
+                log(self._sql, self._args)
+                self._checkout = yield from _connection(_read_pool())
+                conn = self._checkout.__enter__()
+                self._cur = yield from conn.cursor(aiomysql.SSDictCursor)
+                yield from _run(self._cur, self._sql, self._args)
+            with metrics.span('db'):
+                rows = yield from self._cur.fetchmany(self._batch)
+            if not rows:
+                yield from self.close()
+                raise StopAsyncIteration
+            self._rows.extend(rows)
+        return self._factory(**self._rows.popleft())
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+
+    @asyncio.coroutine
+    def close(self):
+        self._closed = True
+        self._rows.clear()
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            yield from cur.close()        #Unbuffered cursor: discards the rows left on the server
+        if self._checkout is not None:
+            checkout, self._checkout = self._checkout, None
+            checkout.__exit__(None, None, None)
+
+def encode_cursor(*values):
+    '''
+    Pack the values of the last row of a page into an opaque token.
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Unpack a token made by encode_cursor, raises ValueError if it is malformed.
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or not all(isinstance(v, (str, int, float)) for v in values):
+        raise ValueError('Invalid cursor: %s' % cursor)        #Lists or dicts would reach MySQL as arguments
+    return values
+
+class Record(object):
+    '''
+    Row of a model with one slot per column, much smaller than a Model dict.
+    Returned by findAll, findPage and iterAll with records=True, to be read: its slots can be
+    assigned (guarding them would slow down building records), but only toModel() can be saved or updated.
+    Supports attribute access, dict(record), toDict() and toModel().
+    __init__ and toDict are generated for the columns, see _record_class.
+    '''
+    __slots__ = ()
+    __model__ = None
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def toModel(self):
+        '''
+        Model instance of the row, to save or update it.
+        '''
+        return self.__model__(**dict(self))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, dict(self))
+
+def _record_class(model, columns):
+    '''
+    Record class of model. Its __init__ assigns the slots directly and toDict builds a dict literal,
+    a loop of setattr/getattr made records slower to build than models.
+    '''
+    namespace = dict()
+    source = 'def __init__(self, %s, **kw):\n%s\n' % (
+        ', '.join('%s=None' % c for c in columns),
+        '\n'.join('    self.%s = %s' % (c, c) for c in columns))
+    source += 'def toDict(self):\n    return {%s}\n' % ', '.join("'%s': self.%s" % (c, c) for c in model.__json_fields__)
+    exec(source, namespace)
+    return type('%sRecord' % model.__name__, (Record,), dict(__slots__=tuple(columns), __model__=model,
+        __init__=namespace['__init__'], toDict=namespace['toDict']))
+
+def model_class(obj):
+    '''
+    Model of a model instance or a record.
+    '''
+    return obj.__model__ if isinstance(obj, Record) else type(obj)
+
+class Transaction(object):
+    '''
+    Unit of work on one pinned connection. save/update/remove queue writes, which are flushed
+    in one transaction on commit: consecutive saves of a model become one multi-row insert and
+    consecutive removes one `delete ... in (...)`. Listeners are notified after the commit.
+        async with orm.transaction() as tx:
+            tx.save(user)
+            tx.save(blog)
+    Leaving the block with an exception rolls everything back.
+    '''
+    def __init__(self, pool, batch=500):
+        self._pool = pool
+        self._batch = batch
+        self._checkout = None
+        self._conn = None
+        self._queued = []        #(action, model) not flushed yet
+        self._written = []        #(action, model) flushed, notified on commit
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        _pinned.set(True)
+        self._checkout = yield from _connection(self._pool)
+        self._conn = self._checkout.__enter__()
+        yield from self._conn.begin()
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                yield from self.commit()
+            else:
+                yield from self._conn.rollback()
+        finally:
+            self._checkout.__exit__(exc_type, exc, tb)
+            self._checkout = self._conn = None
+
+    def _queue(self, action, model):
+        if isinstance(model, Record):
+            model = model.toModel()        #Records have no __fields__, getValue or __before_write__
+        self._queued.append((action, model))
+
+    def save(self, model):
+        self._queue('save', model)
+
+    def update(self, model):
+        self._queue('update', model)
+
+    def remove(self, model):
+        self._queue('remove', model)
+
+    def _statements(self, queued):
+        '''
+        (sql, args) flushing the queued writes, grouping consecutive saves and removes of a model.
+        '''
+        statements = []
+        i = 0
+        while i < len(queued):
+            action, model = queued[i]
+            cls = type(model)
+            j = i + 1
+            if action != 'update':
+                while j < len(queued) and j - i < self._batch and queued[j][0] == action and type(queued[j][1]) is cls:
+                    j += 1
+            group = [m for a, m in queued[i:j]]
+            if action == 'save':
+                statements.append(cls._insert_many(group))
+            elif action == 'remove':
+                pk = cls.__primary_key__
+                sql = 'delete from `%s` where `%s` in (%s)' % (cls.__table__, pk, create_args_string(len(group)))
+                statements.append((sql, [m.getValue(pk) for m in group]))
+            else:
+                args = list(map(model.getValue, cls.__fields__))
+                args.append(model.getValue(cls.__primary_key__))
+                statements.append((cls.__update__, args))
+            i = j
+        return statements
+
+    @asyncio.coroutine
+    def flush(self):
+        '''
+        Send the queued writes without committing them.
+        '''
+        queued, self._queued = self._queued, []
+        if not queued:
+            return
+        yield from before_write([m for a, m in queued if a != 'remove'])
+        cur = yield from self._conn.cursor()
+        try:
+            for sql, args in self._statements(queued):
+                log(sql)
+                yield from _run(cur, sql, args)
+        finally:
+            yield from cur.close()
+        self._written.extend(queued)
+
+    @asyncio.coroutine
+    def select(self, sql, args, size=None):
+        '''
+        Select on the connection of the transaction, after flushing the queued writes.
+        '''
+        yield from self.flush()
+        log(sql, args)
+        cur = yield from self._conn.cursor(aiomysql.DictCursor)
+        try:
+            yield from _run(cur, sql, args or ())
+            if size:
+                rs = yield from cur.fetchmany(size)
+            else:
+                rs = yield from cur.fetchall()
+        finally:
+            yield from cur.close()
+        return rs
+
+    @asyncio.coroutine
+    def execute(self, sql, args):
+        yield from self.flush()
+        log(sql)
+        cur = yield from self._conn.cursor()
+        try:
+            yield from _run(cur, sql, args)
+            return cur.rowcount
+        finally:
+            yield from cur.close()
+
+    @asyncio.coroutine
+    def commit(self):
+        '''
+        Flush and commit; when either fails the transaction is rolled back and the error raised.
+        '''
+        try:
+            yield from self.flush()
+            yield from self._conn.commit()
+        except BaseException:
+            self._written = []
+            yield from self._conn.rollback()
+            raise
+        written, self._written = self._written, []
+        for action, model in written:
+            yield from notify(action, model)
+
+def transaction():
+    '''
+    New Transaction on the primary pool, to be used with `async with`.
+    '''
+    return Transaction(__pool)
+
+#Loader of the current request, see Model.load
+_loader = contextvars.ContextVar('orm_loader', default=None)
+
+def set_loader(loader):
+    '''
+    Make loader the one of the current request (task). Returns a token for reset_loader.
+    '''
+    return _loader.set(loader)
+
+def reset_loader(token):
+    _loader.reset(token)
+
+class Loader(object):
+    '''
+    Request-scoped batching of lookups by primary key. Keys asked for in the same
+    event loop tick are loaded with one `where pk in (...)` query per model,
+    and the results are kept for the rest of the request.
+    '''
+    def __init__(self, loop=None, batch=500):
+        self._loop = loop or asyncio.get_event_loop()
+        self._batch = batch
+        self._futures = dict()        #(model, pk) => future of the object or None
+        self._pending = dict()        #model => OrderedDict of pk => future, not queried yet
+        self._scheduled = False
+
+    def load(self, model, pk):
+        key = (model, pk)
+        fut = self._futures.get(key)
+        if fut is None:
+            fut = self._futures[key] = asyncio.Future(loop=self._loop)
+            self._pending.setdefault(model, collections.OrderedDict())[pk] = fut
+            if not self._scheduled:
+                self._scheduled = True
+                self._loop.call_soon(self._dispatch)        #After the other loads of this tick
+        return fut
+
+    def forget(self, model, pk):
+        '''
+        Drop a memoized object, e.g. after it has been written.
+        '''
+        fut = self._futures.get((model, pk))
+        if fut is not None and fut.done():
+            del self._futures[(model, pk)]
+
+    def _dispatch(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, dict()
+        for model, futures in pending.items():
+            keys = list(futures)
+            for i in range(0, len(keys), self._batch):
+                chunk = collections.OrderedDict((k, futures[k]) for k in keys[i:i+self._batch])
+                self._loop.create_task(self._fetch(model, chunk))
+
+    @asyncio.coroutine
+    def _fetch(self, model, futures):
+        pk = model.__primary_key__
+        keys = list(futures)
+        try:
+            objs = yield from model.findAll('`%s` in (%s)' % (pk, create_args_string(len(keys))), keys)
+        except Exception as e:
+            for key, fut in futures.items():
+                self._futures.pop((model, key), None)        #Not memoized, a later load retries
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        found = dict((getattr(obj, pk), obj) for obj in objs)
+        for key, fut in futures.items():
+            if not fut.done():
+                fut.set_result(found.get(key))
+
 #The instance of Model will be substantiated with the __new__ method in metaclass ModelMetaClass
 class ModelMetaClass(type):
     def __new__(cls, name, bases, attrs):
@@ -111,6 +817,9 @@ class ModelMetaClass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
+        #Fields sent to clients, e.g. __json_exclude__ = ('password',)
+        exclude = attrs.get('__json_exclude__', ())
+        attrs['__json_fields__'] = [f for f in [primaryKey] + fields if f not in exclude]
         #Constructing default syntax for select, insert, update and delete
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         
@@ -121,12 +830,25 @@ class ModelMetaClass(type):
             create_args_string(len(escaped_fields)+1)
             )
         
+        #Multi-row insert: the prefix is followed by one row placeholder per object
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values ' % (tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields)+1)
+        attrs['__upsert__'] = ' on duplicate key update %s' % ', '.join(map(lambda f: '%s=values(%s)' % (f, f), escaped_fields))
+        
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)    #Pass the new attrs to the subclass
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+        attrs['__queries__'] = LRUCache(maxsize=128)    #findAll statements keyed by query shape
+        attrs['__counts__'] = LRUCache(maxsize=256)    #Results of count(ttl=...)
+        attrs['__field_defaults__'] = dict((k, v.default) for k, v in mappings.items() if v.default is not None)
+        model = type.__new__(cls, name, bases, attrs)    #Pass the new attrs to the subclass
+        model.__record__ = _record_class(model, [primaryKey] + fields)        #Compact rows, see records=True of findAll
+        return model
 
 #Create a class using metaclass ModelMetaClass        
 class Model(dict, metaclass=ModelMetaClass):
+    __before_write__ = None        #Coroutine method run before the object is saved or updated, e.g. to fill derived columns
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)    #Using init() in ModelMetaClass
         
@@ -139,77 +861,263 @@ class Model(dict, metaclass=ModelMetaClass):
     def __setattr__(self, key, value):
         self[key] = value
         
+    def toDict(self):
+        '''
+        Plain dict of the fields to expose, leaving out those in __json_exclude__.
+        '''
+        return dict((k, self[k]) for k in self.__json_fields__ if k in self)
+        
     def getValue(self, key):
         return getattr(self, key, None)
         
     def getValueOrDefault(self, key):
-        value = getattr(self, key, None)
+        value = self.get(key)
         if value is None:
-            field = self.__mappings__[key]
-            if field.default is not None:
-                value = field.default() if callable(field.default) else field.default
+            default = self.__field_defaults__.get(key)
+            if default is not None:
+                value = default() if callable(default) else default
                 logging.debug('Using default value for %s: %s' % (key, str(value)))
-                setattr(self, key, value)
+                self[key] = value
         return value
         
     @classmethod
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
+    def _build_select(cls, where, orderBy, shape):
         '''
-        Find objects by where clause.'
+        Build the select statement of a query shape, shape is the number of limit arguments.
         '''
         sql = [cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
+        if shape == 1:
+            sql.append('limit ?')
+        elif shape == 2:
+            sql.append('limit ?, ?')
+        return ' '.join(sql)
+
+    @classmethod
+    def _select_sql(cls, where, orderBy, shape):
+        key = (where, orderBy, shape)
+        sql = cls.__queries__.get(key)
+        if sql is None:
+            sql = cls._build_select(where, orderBy, shape)
+            cls.__queries__.set(key, sql)
+        return sql
+
+    @classmethod
+    @asyncio.coroutine
+    def findAll(cls, where=None, args=None, **kw):
+        '''
+        Find objects by where clause.'
+        primary=True reads from the primary server instead of a replica.
+        records=True returns Records (slotted rows) instead of models, cheaper for rows only sent or rendered.
+        '''
+        if args is None:
+            args = []
+        orderBy = kw.get('orderBy', None)
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        if limit is None:
+            shape = None
+        elif isinstance(limit, int):
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        rs = yield from select(cls._select_sql(where, orderBy, shape), args, primary=kw.get('primary', None))
+        factory = cls.__record__ if kw.get('records') else cls
+        return [factory(**r) for r in rs]
+
+    @classmethod
+    def iterAll(cls, where=None, args=None, batch=500, **kw):
+        '''
+        Iterate objects by where clause without loading the whole result:
+            async for blog in Blog.iterAll(orderBy='created_time desc'):
+        records=True iterates Records, as findAll.
+        '''
+        sql = cls._select_sql(where, kw.get('orderBy', None), None)
+        return RowIterator(sql, args, batch, cls.__record__ if kw.get('records') else cls)
         
+    @classmethod
+    @asyncio.coroutine
+    def findPage(cls, where=None, args=None, cursor=None, limit=20, key='created_time', records=False):
+        '''
+        Keyset pagination, newest first. Seeks past the (key, primary key) of the last row
+        instead of using an offset, so every page costs the same. Returns (objects, next cursor),
+        the next cursor is None on the last page.
+        '''
+        pk = cls.__primary_key__
+        args = list(args or [])
+        conditions = ['(%s)' % where] if where else []        #where may hold an or
+        if cursor:
+            value, last = decode_cursor(cursor)
+            conditions.append('(`%s` < ? or (`%s` = ? and `%s` < ?))' % (key, key, pk))
+            args.extend([value, value, last])
+        where = ' and '.join(conditions) or None
+        orderBy = '`%s` desc, `%s` desc' % (key, pk)        #Served by the index on key, InnoDB appends the primary key to it
+        objs = yield from cls.findAll(where, args, orderBy=orderBy, limit=limit+1, records=records)
+        if len(objs) <= limit:
+            return objs, None
+        objs = objs[:limit]
+        last = objs[-1]
+        return objs, encode_cursor(getattr(last, key), getattr(last, pk))
+
+    @classmethod
     @asyncio.coroutine
     def findNumber(cls, selectField, where=None, args=None):
         """
-        Find number with a specified field
+        Find number with a specified field, e.g. findNumber('count(id)'). Returns a scalar.
         """
-        sql = [cls.__select__]
+        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
+        rs = yield from select(' '.join(sql), args, 1)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
+    @classmethod
+    @asyncio.coroutine
+    def count(cls, where=None, args=None, ttl=None):
+        """
+        Count rows by where clause. With ttl the result is cached that many seconds,
+        or until the next write to the model.
+        """
+        if ttl:
+            key = (where, tuple(args or ()))
+            num = cls.__counts__.get(key)
+            if num is not None:
+                return num
+        num = yield from cls.findNumber('count(*)', where, args)
+        if ttl:
+            cls.__counts__.set(key, num, ttl)
+        return num
+
+    @classmethod
+    @asyncio.coroutine
+    def exists(cls, where=None, args=None):
+        sql = ['select 1 from `%s`' % cls.__table__]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        sql.append('limit 1')
+        rs = yield from select(' '.join(sql), args, 1)
+        return len(rs) > 0
+
+    @classmethod
+    @asyncio.coroutine
+    def min(cls, field, where=None, args=None):
+        return (yield from cls.findNumber('min(`%s`)' % field, where, args))
+
+    @classmethod
+    @asyncio.coroutine
+    def max(cls, field, where=None, args=None):
+        return (yield from cls.findNumber('max(`%s`)' % field, where, args))
+
+    @classmethod
+    @asyncio.coroutine
+    def countBy(cls, field, where=None, args=None):
+        """
+        Grouped count, e.g. Comment.countBy('blog_id') returns a dict of blog id => comments.
+        """
+        sql = ['select `%s` _key_, count(*) _num_ from `%s`' % (field, cls.__table__)]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        sql.append('group by `%s`' % field)
+        rs = yield from select(' '.join(sql), args)
+        return dict((r['_key_'], r['_num_']) for r in rs)
         
-        rs = yield from select(' '.join(sql))
-        return [cls(**r)]
-        
+    @classmethod
+    def load(cls, pk):
+        '''
+        Find object by primary key through the Loader of the current request, batched
+        with the other loads of the same tick. Without a loader it is a plain find.
+        '''
+        loader = _loader.get()
+        if loader is None:
+            return cls.find(pk)
+        return loader.load(cls, pk)
+
+    @classmethod
+    def loadMany(cls, pks):
+        '''
+        Objects of pks in order, None for those not found, in one batched query.
+        '''
+        return asyncio.gather(*[cls.load(pk) for pk in pks])
+
+    @classmethod
     @asyncio.coroutine
-    def find(cls, pk):
+    def find(cls, pk, primary=None):
         '''Find object by primary key.'''
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = yield from select(cls.__find__, [pk], 1, primary)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
         
     @asyncio.coroutine
     def save(self):
+        yield from before_write([self])
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = yield from execute(self.__insert__, args)
         if rows != 1:
             logging.warn('Failed to insert record: affected rows: %s' % rows)
+        yield from notify('save', self)
+
+    @asyncio.coroutine
+    def update(self):
+        yield from before_write([self])
+        args = list(map(self.getValue, self.__fields__))
+        args.append(self.getValue(self.__primary_key__))
+        rows = yield from execute(self.__update__, args)
+        if rows != 1:
+            logging.warn('Failed to update by primary key: affected rows: %s' % rows)
+        yield from notify('update', self)
+
+    @asyncio.coroutine
+    def remove(self):
+        args = [self.getValue(self.__primary_key__)]
+        rows = yield from execute(self.__delete__, args)
+        if rows != 1:
+            logging.warn('Failed to remove by primary key: affected rows: %s' % rows)
+        yield from notify('remove', self)
+
+    @classmethod
+    def _insert_many(cls, objs, upsert=False):
+        '''
+        (sql, args) inserting objs with one multi-row statement.
+        '''
+        columns = cls.__fields__ + [cls.__primary_key__]
+        args = []
+        for obj in objs:
+            args.extend(map(obj.getValueOrDefault, columns))
+        sql = cls.__insert_many__ + ', '.join([cls.__insert_row__] * len(objs))
+        if upsert:
+            sql += cls.__upsert__
+        return sql, args
+
+    @classmethod
+    @asyncio.coroutine
+    def saveMany(cls, objs, chunkSize=500, upsert=False):
+        '''
+        Insert objects with multi-row statements of at most chunkSize rows, one transaction per chunk.
+        With upsert, rows whose primary key exists are updated instead (MySQL counts them as 2 affected rows).
+        Returns the rows affected by every chunk.
+        '''
+        objs = list(objs)
+        yield from before_write(objs)
+        batches = [cls._insert_many(objs[i:i+chunkSize], upsert) for i in range(0, len(objs), chunkSize)]
+        counts = yield from execute_batches(batches)
+        for obj in objs:
+            yield from notify('save', obj)
+        return counts
     
 class Field(object):
     def __init__(self, name, column_type, primary_key, default):
@@ -0,0 +1,41 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+passwords.py
+Password storage with PBKDF2-HMAC-SHA256, stored as pbkdf2_sha256$iterations$salt$hash (base64).
+The key derivation is slow on purpose, so it runs in the process pool, never on the event loop.
+'''
+
+import os, hmac, base64, hashlib
+
+from executor import offload
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 100000
+SALT_SIZE = 16
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _derive(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+@offload('process')
+def hash_password(password, iterations=ITERATIONS):
+    salt = os.urandom(SALT_SIZE)
+    return '%s$%s$%s$%s' % (ALGORITHM, iterations, _b64(salt), _b64(_derive(password, salt, iterations)))
+
+@offload('process')
+def verify_password(password, stored):
+    '''
+    Whether password matches a value returned by hash_password, compared in constant time.
+    '''
+    try:
+        algorithm, iterations, salt, expected = stored.split('$')
+    except ValueError:
+        return False
+    if algorithm != ALGORITHM:
+        return False
+    derived = _derive(password, base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(_b64(derived), expected)
@@ -0,0 +1,115 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+prefork.py
+Pre-fork worker mode. A supervisor process forks workers sharing one listening address,
+respawns those that die and replaces all of them gracefully on SIGHUP.
+'''
+
+import os, signal, socket, time, logging
+
+def bind_socket(host, port, reuse_port=False, backlog=128):
+    '''
+    Create a listening socket. With reuse_port every worker binds its own socket
+    and the kernel balances connections between them (SO_REUSEPORT).
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+class Supervisor(object):
+    '''
+    Fork workers running target(sock) and keep their number at workers.
+    SIGTERM/SIGINT stop the workers and exit, SIGHUP starts a new set of workers
+    and then asks the old ones to finish their requests and exit. SIGUSR1 is passed on
+    to the workers (it toggles request profiling).
+    '''
+    def __init__(self, target, workers, host, port, reuse_port=False):
+        self.target = target
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self._sock = None
+        self._children = dict()        #pid => (generation, start time)
+        self._generation = 0
+        self._running = False
+
+    def run(self):
+        if not self.reuse_port:
+            self._sock = bind_socket(self.host, self.port)        #Inherited by every worker
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        signal.signal(signal.SIGUSR1, self._on_forward)
+        self._running = True
+        logging.info('Supervisor %s starting %s workers on %s:%s...' % (os.getpid(), self.workers, self.host, self.port))
+        for i in range(self.workers):
+            self._spawn()
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            generation, started = self._children.pop(pid, (None, 0))
+            if generation is None:
+                continue
+            if self._running and generation == self._generation:
+                logging.warning('Worker %s exited with status %s, respawning...' % (pid, status))
+                if time.time() - started < 1:
+                    time.sleep(1)        #Do not spin on a worker failing at startup
+                self._spawn()
+        if self._sock is not None:
+            self._sock.close()
+        logging.info('Supervisor %s stopped.' % os.getpid())
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)        #The worker installs its own handlers
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            code = 0
+            try:
+                sock = self._sock if self._sock is not None else bind_socket(self.host, self.port, True)
+                self.target(sock)
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        self._children[pid] = (self._generation, time.time())
+        return pid
+
+    def _signal_all(self, sig, generation=None):
+        for pid, (g, started) in list(self._children.items()):
+            if generation is None or g == generation:
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def _on_forward(self, signum, frame):
+        self._signal_all(signum)
+
+    def _on_stop(self, signum, frame):
+        logging.info('Supervisor stopping workers...')
+        self._running = False
+        self._signal_all(signal.SIGTERM)
+
+    def _on_restart(self, signum, frame):
+        if not self._running:
+            return
+        logging.info('Supervisor restarting workers...')
+        old = self._generation
+        self._generation += 1
+        for i in range(self.workers):
+            self._spawn()
+        self._signal_all(signal.SIGTERM, old)        #Old workers finish their requests and exit
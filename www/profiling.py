@@ -0,0 +1,57 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+profiling.py
+Sampled cProfile of requests, to find hot paths in production. A fraction rate of the requests
+is profiled, one at a time, and the stats are written to a directory or logged to 'profile'.
+cProfile sees everything the event loop runs while the request is profiled, other requests included.
+Send SIGUSR1 to the server to switch sampling on and off without a restart.
+'''
+
+import os, io, re, time, random, pstats, cProfile, logging
+
+profile_logger = logging.getLogger('profile')
+
+_RE_UNSAFE = re.compile(r'[^0-9A-Za-z_.-]+')
+
+class Sampler(object):
+    '''
+    Decide which requests are profiled, and keep the profile of the one running.
+    '''
+    def __init__(self, rate=0.0, toggle_rate=0.01, directory=None, top=30):
+        self.rate = rate
+        self.toggle_rate = toggle_rate
+        self.directory = directory
+        self.top = top
+        self._profile = None
+
+    def sample(self):
+        '''
+        Start profiling if this request is picked, returns whether it was.
+        '''
+        if self._profile is not None or not self.rate or random.random() >= self.rate:
+            return False
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return True
+
+    def finish(self, name):
+        '''
+        Stop the profile started by sample() and save it as the profile of name (e.g. 'GET /').
+        '''
+        profile, self._profile = self._profile, None
+        profile.disable()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, '%d-%s-%s.prof' % (time.time() * 1000, os.getpid(), _RE_UNSAFE.sub('_', name)))
+            profile.dump_stats(path)        #Read with pstats or snakeviz
+            profile_logger.info('Profile of %s written to %s', name, path)
+        else:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(self.top)
+            profile_logger.info('Profile of %s:\n%s', name, out.getvalue())
+
+    def toggle(self):
+        self.rate = 0.0 if self.rate else self.toggle_rate
+        logging.warning('Request profiling of %s %s (rate %s)' % (os.getpid(), 'on' if self.rate else 'off', self.rate))
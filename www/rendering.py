@@ -0,0 +1,161 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+rendering.py
+Blog and comment content rendered once, when it is written. The HTML (and a blog summary when
+the author gave none) is stored in the row with the hash of the content it comes from, so reads
+serve it as it is. Markdown is rendered by markdown2 when installed, otherwise as escaped paragraphs.
+
+    mysql < database_upgrade.sql    #Adds content_html and content_hash to the tables of an older install
+    python rendering.py    #Backfill rows written before, or render all of them again after a renderer change
+'''
+
+import re, html, hashlib, logging, asyncio
+
+try:
+    import markdown2
+except ImportError:
+    markdown2 = None
+
+import orm
+from cache import LRUCache
+from executor import run_in_process
+
+SUMMARY_SIZE = 200        #Length of blogs.summary
+
+_RE_PARAGRAPH = re.compile(r'\n\s*\n')
+_RE_TAG = re.compile(r'<[^>]+>')
+_RE_SPACE = re.compile(r'\s+')
+
+_rendered = LRUCache(maxsize=1024)        #Content hash => (html, summary), for rows written before the backfill
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def to_html(text):
+    if markdown2 is not None:
+        return markdown2.markdown(text, safe_mode='escape', extras=['fenced-code-blocks'])
+    paragraphs = _RE_PARAGRAPH.split(text.strip())
+    return ''.join('<p>%s</p>\n' % html.escape(p).replace('\n', '<br>\n') for p in paragraphs if p)
+
+def to_summary(html_text, size=SUMMARY_SIZE):
+    '''
+    Plain text of html_text cut to size characters, on a word boundary when there is one.
+    '''
+    text = _RE_SPACE.sub(' ', html.unescape(_RE_TAG.sub(' ', html_text))).strip()
+    if len(text) <= size:
+        return text
+    cut = text[:size-3]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut + '...'
+
+def render(text):
+    '''
+    (html, summary) of a content.
+    '''
+    html_text = to_html(text or '')
+    return html_text, to_summary(html_text)
+
+def render_many(texts):
+    return [render(text) for text in texts]
+
+def _fill(model, digest, rendered):
+    html_text, summary = rendered
+    model.content_html = html_text
+    model.content_hash = digest
+    if 'summary' in model.__mappings__ and not model.get('summary'):
+        model.summary = summary
+
+@asyncio.coroutine
+def prepare_content(model):
+    '''
+    __before_write__ of Blog and Comment: render the content in the process pool unless the stored HTML
+    is from the same content.
+    '''
+    content = model.get('content') or ''
+    digest = content_hash(content)
+    if model.get('content_hash') == digest:
+        return
+    rendered = _rendered.get(digest)
+    if rendered is None:
+        rendered = yield from run_in_process(render, content)
+        _rendered.set(digest, rendered)
+    _fill(model, digest, rendered)
+
+def content_html(row):
+    '''
+    HTML of a blog or comment row, as stored; rows not backfilled yet are rendered and kept in memory.
+    Used as content_html() in templates.
+    '''
+    if row.content_hash:
+        return row.content_html
+    content = row.content or ''
+    digest = content_hash(content)
+    rendered = _rendered.get(digest)
+    if rendered is None:
+        rendered = render(content)
+        _rendered.set(digest, rendered)
+    return rendered[0]
+
+def _backfill_sql(model):
+    '''
+    Update of the rendered columns of a row, only if it was not written since it was read
+    (its content_hash is unchanged): the other columns are left as they are.
+    '''
+    columns = ['`content_html`=?', '`content_hash`=?']
+    if 'summary' in model.__mappings__:
+        columns.append("`summary`=case when `summary`='' then ? else `summary` end")
+    return 'update `%s` set %s where `%s`=? and `content_hash`=?' % (
+        model.__table__, ', '.join(columns), model.__primary_key__)
+
+@asyncio.coroutine
+def _backfill_batch(model, rows):
+    results = yield from run_in_process(render_many, [row.content or '' for row in rows])
+    sql = _backfill_sql(model)
+    batches = []
+    for row, (html_text, summary) in zip(rows, results):
+        args = [html_text, content_hash(row.content or '')]
+        if 'summary' in model.__mappings__:
+            args.append(summary)
+        args.extend([row[model.__primary_key__], row.content_hash or ''])
+        batches.append((sql, args))
+    counts = yield from orm.execute_batches(batches)
+    return sum(counts)
+
+@asyncio.coroutine
+def backfill(model, batch=200, parallel=4):
+    '''
+    Render the content of every row of model again and store it, batch by batch in the process pool
+    with up to parallel batches at once. Returns the number of rows written.
+    '''
+    done = 0
+    pending = set()
+    cursor = None
+    while True:
+        rows, cursor = yield from model.findPage(cursor=cursor, limit=batch)
+        if rows:
+            pending.add(asyncio.ensure_future(_backfill_batch(model, rows)))
+        if cursor is None:
+            break
+        if len(pending) >= parallel:
+            finished, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            done += sum(f.result() for f in finished)
+    if pending:
+        finished, pending = yield from asyncio.wait(pending)
+        done += sum(f.result() for f in finished)
+    logging.info('Rendered %s rows of %s' % (done, model.__table__))
+    return done
+
+if __name__ == '__main__':
+    import executor
+    from config import configs
+    from models import Blog, Comment
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop=loop, **configs.db))
+    executor.setup(**configs.executor)
+    loop.run_until_complete(asyncio.gather(backfill(Blog), backfill(Comment)))
+    executor.shutdown()
+    loop.run_until_complete(orm.close_pool())
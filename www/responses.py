@@ -0,0 +1,97 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+responses.py
+Conditional GET (ETag / 304) and compression of response bodies.
+'''
+
+import hashlib, gzip, zlib
+from collections import OrderedDict
+from email.utils import formatdate
+
+from aiohttp import web
+
+from config import configs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_MIN_SIZE = configs.compress.min_size
+_LEVEL = configs.compress.level
+
+#Supported encodings, in order of preference
+_COMPRESSORS = OrderedDict()
+if brotli is not None:
+    _COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=_LEVEL)
+_COMPRESSORS['gzip'] = lambda body: gzip.compress(body, _LEVEL)
+_COMPRESSORS['deflate'] = lambda body: zlib.compress(body, _LEVEL)
+
+def make_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def accepted_encodings(header):
+    '''
+    Parse Accept-Encoding into the set of encodings with a non-zero quality.
+    '''
+    accepted = set()
+    for item in header.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name)
+    return accepted
+
+def choose_encoding(request, size):
+    if size < _MIN_SIZE:
+        return None
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for name in _COMPRESSORS:
+        if name in accepted:
+            return name
+    return None
+
+def etag_matches(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+def make_response(request, body, content_type, etag=None, last_modified=None, variants=None):
+    '''
+    Response of a full body: 304 to a GET or HEAD whose If-None-Match carries its ETag, otherwise the body
+    compressed with the best encoding the client accepts. variants is a dict of compressed
+    bodies by encoding; pass the one of a cached page so it is compressed only once.
+    '''
+    encoding = choose_encoding(request, len(body))
+    if etag is None:
+        etag = make_etag(body)
+    if encoding:
+        etag = '%s-%s"' % (etag[:-1], encoding)        #Each representation has its own strong ETag
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if request.method in ('GET', 'HEAD') and etag_matches(request, etag):        #Not for the result of a POST
+        return web.HTTPNotModified(headers=headers)
+    if encoding:
+        compressed = variants.get(encoding) if variants is not None else None
+        if compressed is None:
+            compressed = _COMPRESSORS[encoding](body)
+            if variants is not None:
+                variants[encoding] = compressed
+        body = compressed
+        headers['Content-Encoding'] = encoding
+    resp = web.Response(body=body, headers=headers)
+    resp.content_type = content_type
+    return resp
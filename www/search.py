@@ -0,0 +1,275 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+search.py
+Full-text search over blogs and comments with an in-process inverted index and BM25 ranking.
+
+The index is a file read through mmap (term dictionary + packed postings) plus an in-memory
+delta kept up to date from Model writes, so queries never touch MySQL. save() merges the delta
+into a new file. With several workers each one only sees its own writes: rebuild the file
+from MySQL with `python search.py` and the workers reopen it when it changes.
+'''
+
+import os, re, json, math, mmap, heapq, struct, array, logging, asyncio
+
+from orm import model_class
+from models import Blog, Comment
+
+#Used when configs.search.path is None
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'search.idx')
+
+MAGIC = b'ASBIDX1\n'
+POSTING = struct.Struct('<II')        #docno, tf; little-endian whatever the machine, the file may be copied across
+K1 = 1.2
+B = 0.75
+
+#Indexed fields and their weights, a title match counts three times a content match
+FIELDS = {
+    Blog: (('title', 3), ('summary', 2), ('content', 1)),
+    Comment: (('content', 1),)
+}
+
+_RE_TOKEN = re.compile('[0-9a-z]+|[\\u3400-\\u9fff]')        #Words, and CJK characters one by one
+
+def tokenize(text):
+    return _RE_TOKEN.findall(text.lower()) if text else []
+
+def doc_key(obj):
+    cls = model_class(obj)
+    return '%s:%s' % (cls.__table__, obj.get(cls.__primary_key__))
+
+def _title(model):
+    text = model.get('title') or model.get('content') or ''
+    return text[:80]
+
+class SearchIndex(object):
+    '''
+    Inverted index of documents (key => weighted terms). Documents live either in the
+    mmap'ed base segment or in the delta, docnos removed from the base are masked.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self._mm = None
+        self._file = None
+        self._base = dict()        #term => (offset, count) in the postings of the file
+        self._keys = []        #docno => key, None once removed
+        self._titles = []        #docno => title shown in results
+        self._lengths = array.array('I')        #docno => weighted length
+        self._docnos = dict()        #key => docno
+        self._delta = dict()        #term => {docno: tf}, documents added since the file was written
+        self._delta_terms = dict()        #docno => terms of a delta document, to remove it
+        self._deleted = set()        #Base docnos removed or replaced
+        self._total = 0        #Sum of the lengths of the live documents
+        self._mtime = None
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Index of the file at path, empty if there is none yet.
+        '''
+        index = cls(path)
+        if os.path.isfile(path):
+            index._load()
+        return index
+
+    def _load(self):
+        f = open(self.path, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            f.close()
+            raise ValueError('Not a search index: %s' % self.path)
+        size, = struct.unpack('<Q', mm[len(MAGIC):len(MAGIC)+8])
+        start = len(MAGIC) + 8
+        header = json.loads(mm[start:start+size].decode('utf-8'))
+        self._postings_start = start + size
+        self._keys = header['keys']
+        self._titles = header['titles']
+        self._lengths = array.array('I', header['lengths'])
+        self._base = dict((t, tuple(v)) for t, v in header['terms'].items())
+        self._docnos = dict((k, n) for n, k in enumerate(self._keys))
+        self._total = sum(self._lengths)
+        self._mm, self._file = mm, f
+        self._mtime = os.path.getmtime(self.path)
+        logging.info('Search index loaded: %s documents, %s terms' % (len(self._keys), len(self._base)))
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = self._file = None
+
+    def __len__(self):
+        return len(self._docnos)
+
+    def _base_postings(self, term):
+        entry = self._base.get(term)
+        if entry is None or self._mm is None:
+            return ()
+        offset, count = entry
+        start = self._postings_start + offset
+        return POSTING.iter_unpack(memoryview(self._mm)[start:start+count*POSTING.size])
+
+    def postings(self, term):
+        '''
+        (docno, tf) of the live documents containing term.
+        '''
+        for docno, tf in self._base_postings(term):
+            if docno not in self._deleted:
+                yield docno, tf
+        delta = self._delta.get(term)
+        if delta:
+            for item in delta.items():
+                yield item
+
+    def remove(self, key):
+        docno = self._docnos.pop(key, None)
+        if docno is None:
+            return
+        terms = self._delta_terms.pop(docno, None)
+        if terms is None:
+            self._deleted.add(docno)
+        else:
+            for term in terms:
+                postings = self._delta[term]
+                postings.pop(docno, None)
+                if not postings:
+                    del self._delta[term]
+        self._total -= self._lengths[docno]
+        self._keys[docno] = None
+
+    def add(self, key, title, fields):
+        '''
+        Index a document (replacing any with the same key). fields is a list of (text, weight).
+        '''
+        self.remove(key)
+        counts = dict()
+        for text, weight in fields:
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + weight
+        docno = len(self._keys)
+        length = sum(counts.values())
+        self._keys.append(key)
+        self._titles.append(title)
+        self._lengths.append(length)
+        self._docnos[key] = docno
+        self._total += length
+        for term, tf in counts.items():
+            self._delta.setdefault(term, dict())[docno] = tf
+        self._delta_terms[docno] = list(counts)
+
+    def add_model(self, model):
+        weights = FIELDS[model_class(model)]
+        self.add(doc_key(model), _title(model), [(model.get(name), w) for name, w in weights])
+
+    def search(self, query, limit=20):
+        '''
+        Best documents for query by BM25: list of (key, title, score).
+        '''
+        n = len(self._docnos)
+        if n == 0:
+            return []
+        avgdl = self._total / n or 1.0
+        scores = dict()
+        for term in set(tokenize(query)):
+            postings = list(self.postings(term))
+            if not postings:
+                continue
+            df = len(postings)        #Live documents only, removed and replaced ones would make idf negative
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for docno, tf in postings:
+                norm = K1 * (1 - B + B * self._lengths[docno] / avgdl)
+                scores[docno] = scores.get(docno, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self._keys[docno], self._titles[docno], score) for docno, score in best]
+
+    def save(self, path=None):
+        '''
+        Write base and delta merged into a compact file (removed documents dropped, docnos
+        renumbered) and reopen the index from it.
+        '''
+        path = path or self.path
+        live = [docno for docno, key in enumerate(self._keys) if key is not None]
+        renumber = dict((old, new) for new, old in enumerate(live))
+        terms = dict()
+        for term in set(self._base) | set(self._delta):
+            pairs = [(renumber[d], tf) for d, tf in self.postings(term)]
+            if pairs:
+                terms[term] = pairs
+        blob = array.array('I')
+        directory = dict()
+        for term, pairs in terms.items():
+            directory[term] = (len(blob) // 2 * POSTING.size, len(pairs))
+            for docno, tf in sorted(pairs):
+                blob.append(docno)
+                blob.append(tf)
+        header = json.dumps(dict(
+            keys=[self._keys[d] for d in live],
+            titles=[self._titles[d] for d in live],
+            lengths=[self._lengths[d] for d in live],
+            terms=directory), ensure_ascii=False).encode('utf-8')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(struct.pack('<%dI' % len(blob), *blob))
+        os.replace(tmp, path)
+        self.reopen(path)
+
+    def reopen(self, path=None):
+        '''
+        Drop everything in memory and load the file again, e.g. after another process rebuilt it.
+        '''
+        self.close()
+        self.__init__(path or self.path)
+        self._load()
+
+    def changed(self):
+        '''
+        Whether the file was replaced since it was loaded.
+        '''
+        try:
+            return os.path.getmtime(self.path) != self._mtime
+        except OSError:
+            return False
+
+    def on_change(self, action, model):
+        '''
+        orm listener keeping the index up to date with the writes of this process.
+        '''
+        if model_class(model) not in FIELDS:
+            return
+        if action == 'remove':
+            self.remove(doc_key(model))
+        else:
+            self.add_model(model)
+
+@asyncio.coroutine
+def rebuild(path):
+    '''
+    Index every blog and comment, streaming them from MySQL, and write the file.
+    '''
+    index = SearchIndex(path)
+    for model in FIELDS:
+        rows = model.iterAll(records=True)
+        while True:
+            try:
+                row = yield from rows.__anext__()
+            except StopAsyncIteration:
+                break
+            index.add_model(row)
+    index.save(path)
+    logging.info('Search index rebuilt: %s documents' % len(index))
+    return index
+
+if __name__ == '__main__':
+    import orm
+    from config import configs
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop=loop, **configs.db))
+    loop.run_until_complete(rebuild(configs.search.path or DEFAULT_PATH))
+    loop.run_until_complete(orm.close_pool())
@@ -0,0 +1,88 @@
+#coding = utf-8
+__author__ = 'aresowj'
+
+'''
+serializer.py
+JSON encoding of responses. Uses orjson when it is installed, the json module otherwise.
+Models are encoded through their fields, see Model.toDict().
+'''
+
+import json
+
+from orm import Model, Record
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(o):
+    if isinstance(o, (Model, Record)):
+        return o.toDict()
+    return o.__dict__
+
+def _prepare(obj):
+    '''
+    Replace models by their dicts, the json module encodes dict subclasses as they are instead of
+    passing them to default. Containers are only copied when they hold a model, records and other
+    objects are converted by _default while encoding.
+    '''
+    if isinstance(obj, Model):
+        return obj.toDict()
+    if isinstance(obj, dict):
+        prepared = None
+        for k, v in obj.items():
+            p = _prepare(v)
+            if p is not v:
+                if prepared is None:
+                    prepared = dict(obj)
+                prepared[k] = p
+        return obj if prepared is None else prepared
+    if isinstance(obj, (list, tuple)):
+        prepared = None
+        for i, v in enumerate(obj):
+            p = _prepare(v)
+            if p is not v:
+                if prepared is None:
+                    prepared = list(obj)
+                prepared[i] = p
+        return obj if prepared is None else prepared
+    return obj
+
+if orjson is not None:
+    def dumps(obj):
+        '''
+        Encode obj to UTF-8 JSON bytes.
+        '''
+        #Let models reach _default instead of being encoded as plain dicts
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_SUBCLASS)
+else:
+    def dumps(obj):
+        '''
+        Encode obj to UTF-8 JSON bytes.
+        '''
+        return json.dumps(_prepare(obj), ensure_ascii=False, default=_default).encode('utf-8')
+
+def iter_dumps(obj, chunk=256):
+    '''
+    Encode a dict piece by piece, splitting its list values every chunk items,
+    so a large list is never held as one encoded string.
+    '''
+    yield b'{'
+    for n, (k, v) in enumerate(obj.items()):
+        key = (b',' if n else b'') + dumps(str(k)) + b':'
+        if isinstance(v, (list, tuple)):
+            yield key + b'['
+            for i in range(0, len(v), chunk):
+                part = dumps(list(v[i:i+chunk]))[1:-1]        #Strip the brackets
+                yield (b',' + part) if i else part
+            yield b']'
+        else:
+            yield key + dumps(v)
+    yield b'}'
+
+def count_items(obj):
+    '''
+    Number of items in the list values of a dict, to decide whether to stream it.
+    '''
+    return sum(len(v) for v in obj.values() if isinstance(v, (list, tuple)))